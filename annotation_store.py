@@ -0,0 +1,235 @@
+import json
+import os
+
+
+annotation_log = 'images_and_roi.jsonl'
+scan_ledger = 'scan_ledger.jsonl'
+
+
+def migrate_legacy_json(log_path=annotation_log, last_scan_path='last_scan.json'):
+    """Writes the entries of the last images_and_roi{roi_count}.json to the annotation log,
+    if the log doesn't exist yet. The old json files have no mediagate ids, they are stored as None.
+
+    Returns:
+        Bool : True if the log exists afterwards, False otherwise
+    """
+    if os.path.exists(log_path):
+        return True
+    if not os.path.exists(last_scan_path):
+        return False
+    with open(last_scan_path) as f:
+        roi_count = json.load(f)['roi_count']
+    if not os.path.exists(f'images_and_roi{roi_count}.json'):
+        return False
+
+    with open(f'images_and_roi{roi_count}.json') as f:
+        images_and_annotation = json.load(f)
+    with open(log_path + '.tmp', 'w') as f:
+        for image_path, roi_mm in images_and_annotation.items():
+            f.write(json.dumps({'mediagate_id': None, 'image_path': image_path, 'roi_mm': roi_mm}) + '\n')
+    os.replace(log_path + '.tmp', log_path)
+    return True
+
+
+def iter_annotations(log_path=annotation_log):
+    """Streams the annotation log line by line.
+
+    Yields:
+        (mediagate_id, image_path, roi_mm)
+    """
+    migrate_legacy_json(log_path)
+    with open(log_path) as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break # incomplete last line of an interrupted write
+            record = json.loads(line)
+            yield record['mediagate_id'], record['image_path'], record['roi_mm']
+
+
+def load_annotations(log_path=annotation_log):
+    """Returns the annotation log as dict(image_path : [x,y,w,h]), like the old images_and_roi{roi_count}.json."""
+    return {image_path: roi_mm for _, image_path, roi_mm in iter_annotations(log_path)}
+
+
+def truncate_after(mediagate_id, log_path=annotation_log):
+    """Removes the entries after mediagate_id (and an incomplete last line) from the log.
+    The scan writes the log in mediagate id order, so these are the entries written after the
+    last checkpoint in last_scan.json, they are written again when the scan resumes from there."""
+    if not os.path.exists(log_path):
+        return
+    with open(log_path, 'rb+') as f:
+        offset = 0
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            record_id = json.loads(line)['mediagate_id']
+            if record_id is not None and record_id > mediagate_id:
+                break
+            offset += len(line)
+        f.truncate(offset)
+
+
+class AnnotationLog:
+    """Append-only writer for the annotation log. Every hit is written as one json line, as it arrives.
+
+    Example:
+        with AnnotationLog() as log:
+            log.append(mediagate_id, {image_path : [x,y,w,h]})
+            log.sync()
+    """
+
+    def __init__(self, log_path=annotation_log):
+        self.log_path = log_path
+        self.file = open(log_path, 'a')
+
+    def append(self, mediagate_id, annotation):
+        for image_path, roi_mm in annotation.items():
+            self.file.write(json.dumps({'mediagate_id': mediagate_id, 'image_path': image_path, 'roi_mm': roi_mm}) + '\n')
+        self.file.flush()
+
+    def sync(self):
+        """Makes sure the appended lines are on disk, before a checkpoint refers to them."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_ledger(ledger_path=scan_ledger):
+    """Streams the scan ledger line by line.
+
+    Yields:
+        dict(mediagate_id, outcome, ...) , see ScanLedger
+    """
+    if not os.path.exists(ledger_path):
+        return
+    with open(ledger_path) as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            yield json.loads(line)
+
+
+class ScanLedger:
+    """Append-only json lines file with one record per scanned mediagate id, accepted or not, written in mediagate id order.
+    With the raw measurements the accepted annotations can be rebuilt for another tolerance without scanning again
+    (see update_dataset.rebuild_annotations).
+
+    Records:
+        {'mediagate_id', 'outcome': 'measured', 'image_path', 'enc_wh': [w,h], 'roi_mm': [x,y,w,h]}
+        {'mediagate_id', 'outcome': 'daily'}                      fileinfo says FILE_TYPE daily
+        {'mediagate_id', 'outcome': 'no_xml', 'image_path'}       xml sidecar not found
+        {'mediagate_id', 'outcome': 'error', 'error': 'KeyError'} exception while scanning the id
+    """
+
+    def __init__(self, ledger_path=scan_ledger):
+        self.ledger_path = ledger_path
+        self.file = open(ledger_path, 'a')
+
+    def append(self, record):
+        self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RoiPercentStore:
+    """dict(local_image_path : roi_in_percent) of the processed images, i.e. images_roi_percent_latest.json.
+
+    Changes are appended to a delta log (json lines) as they happen and are written to disk in batches
+    of flush_every. commit writes the full json to a temporary file and replaces images_roi_percent_latest.json
+    atomically, then the delta log is emptied. After a crash, the json and the remaining delta log are
+    replayed on load, so only the changes of the last unflushed batch are lost. Without any change (and no
+    delta log to fold in) commit does nothing.
+    """
+
+    def __init__(self, path='images_roi_percent_latest.json', flush_every=100):
+        self.path = path
+        self.delta_path = path + '.delta'
+        self.flush_every = flush_every
+        self.pending = []
+        self.changed = False
+
+        if os.path.exists(path):
+            with open(path) as f:
+                self.roi_percent = json.load(f)
+        else:
+            self.roi_percent = {}
+
+        if os.path.exists(self.delta_path):
+            with open(self.delta_path) as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    image_path, roi_in_percent = json.loads(line)
+                    self.changed = True
+                    if roi_in_percent is None:
+                        self.roi_percent.pop(image_path, None)
+                    else:
+                        self.roi_percent[image_path] = roi_in_percent
+
+    def __contains__(self, image_path):
+        return image_path in self.roi_percent
+
+    def __getitem__(self, image_path):
+        return self.roi_percent[image_path]
+
+    def __len__(self):
+        return len(self.roi_percent)
+
+    def items(self):
+        return self.roi_percent.items()
+
+    def update(self, image_path, roi_in_percent):
+        if self.roi_percent.get(image_path) == roi_in_percent:
+            return
+        self.roi_percent[image_path] = roi_in_percent
+        self._log_change(image_path, roi_in_percent)
+
+    def pop(self, image_path):
+        if image_path in self.roi_percent:
+            self.roi_percent.pop(image_path)
+            self._log_change(image_path, None)
+
+    def _log_change(self, image_path, roi_in_percent):
+        self.changed = True
+        self.pending.append(json.dumps([image_path, roi_in_percent]) + '\n')
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with open(self.delta_path, 'a') as f:
+            f.writelines(self.pending)
+        self.pending = []
+
+    def commit(self):
+        if not self.changed:
+            return
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.roi_percent, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + '.tmp', self.path)
+        self.pending = []
+        self.changed = False
+        if os.path.exists(self.delta_path):
+            os.remove(self.delta_path)
@@ -0,0 +1,434 @@
+"""
+Offline benchmark of the pipeline stages. Everything runs on synthetic data in a temporary directory, no share and no
+company network needed:
+
+    - 300 DPI jpegs (default A4, 2480 x 3508) with pageboxes xml sidecars, laid out like repro_files
+    - a local stub of the MediagateDetails and clynx fileinfo endpoints
+    - CLIP embeddings for get_best_daily2order
+
+Every stage is timed at every dataset size, the report (json) has the time, throughput and peak memory (resident set size
+of the process, sampled while the stage runs) of each.
+
+    python benchmark.py --sizes 20 100 --report benchmark_report.json
+
+Before the benchmark, check_read_mediagate_infos checks the batched MediagateDetails lookup against stubs with
+shuffled, missing and id-less results (fails with an AssertionError); only the check:
+
+    python benchmark.py --check_only
+"""
+
+from contextlib import redirect_stderr, redirect_stdout
+import argparse
+import create_gaussian_dataset
+import cv2 as cv
+import fetch_images
+import gc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import mediagate_client
+import numpy as np
+import os
+import path_resolver
+import platform
+import prio_dataset
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import update_dataset
+from urllib.parse import parse_qs, urlparse
+
+
+first_mediagate_id = 5000000
+page_mm = (210, 297) # A4
+bench_dpi = 300
+mm_per_point = 25.4/72
+
+
+def page_size_px(page_mm, dpi=bench_dpi):
+    return int(round(page_mm[0]/25.4*dpi)), int(round(page_mm[1]/25.4*dpi))
+
+
+def synthetic_page(width, height, rng):
+    """A page with a few coloured boxes, lines and text, compresses like a real artwork (no noise)."""
+    image = np.full((height, width, 3), 255, dtype=np.uint8)
+    image[:] = np.linspace(200, 255, width, dtype=np.uint8)[None, :, None]
+    for _ in range(12):
+        x, y = int(rng.integers(0, width-100)), int(rng.integers(0, height-100))
+        w, h = int(rng.integers(50, width//3)), int(rng.integers(50, height//3))
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        cv.rectangle(image, (x, y), (x+w, y+h), color, -1 if rng.random()<0.5 else 8)
+    for line in range(20):
+        cv.putText(image, f"Lorem ipsum {int(rng.integers(0, 10**6))}", (int(width*0.1), int(height*(0.05+line*0.045))),
+                   cv.FONT_HERSHEY_SIMPLEX, width/1000, (20, 20, 20), max(width//600, 1))
+    return image
+
+
+def pageboxes_xml(page_mm, trim_mm):
+    """xml sidecar with media and trim box (in points, origin at the bottom left corner) like the repro files."""
+    media_w, media_h = page_mm[0]/mm_per_point, page_mm[1]/mm_per_point
+    trim_x, trim_y, trim_w, trim_h = [v/mm_per_point for v in trim_mm]
+    trim_y_bottom = media_h - trim_y - trim_h
+    return ("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n<document>\n <pageboxes>\n"
+            f"  <media><offsetx>0</offsetx><offsety>0</offsety><width>{media_w:.3f}</width><height>{media_h:.3f}</height></media>\n"
+            f"  <trim><offsetx>{trim_x:.3f}</offsetx><offsety>{trim_y_bottom:.3f}</offsety><width>{trim_w:.3f}</width><height>{trim_h:.3f}</height></trim>\n"
+            " </pageboxes>\n <separations>" + "<separation name=\"Cyan\"/>"*50 + "</separations>\n</document>\n")
+
+
+def generate_share(share_dir, count, page_mm=page_mm, seed=0):
+    """Writes count repro files (jpeg, _RAW jpeg, xml) to share_dir/<mediagate_id>/.
+
+    Returns:
+        dict(mediagate_id : {'image_path', 'trim_mm', 'enc_wh'}) ; every 5th id has an encoway size that doesn't match
+    """
+    rng = np.random.default_rng(seed)
+    width, height = page_size_px(page_mm)
+    files = {}
+    for mediagate_id in range(first_mediagate_id+1, first_mediagate_id+1+count):
+        directory = os.path.join(share_dir, str(mediagate_id))
+        os.makedirs(directory, exist_ok=True)
+        image_path = os.path.join(directory, f"{mediagate_id}.jpg")
+        cv.imwrite(image_path, synthetic_page(width, height, rng), [cv.IMWRITE_JPEG_QUALITY, 90])
+        shutil.copy(image_path, os.path.join(directory, f"{mediagate_id}_RAW.jpg"))
+
+        trim_mm = [float(rng.uniform(5, 20)), float(rng.uniform(5, 20)), float(rng.uniform(100, 180)), float(rng.uniform(150, 260))]
+        with open(os.path.join(directory, f"{mediagate_id}.xml"), 'w') as f:
+            f.write(pageboxes_xml(page_mm, trim_mm))
+        enc_wh = trim_mm[2:] if mediagate_id%5 else [trim_mm[2]*1.2, trim_mm[3]]
+        files[mediagate_id] = {'image_path': f"/{mediagate_id}/{mediagate_id}.jpg", 'trim_mm': trim_mm, 'enc_wh': enc_wh}
+    return files
+
+
+def generate_embeddings(clip_dir, daily_count, orders_per_daily=5, seed=0):
+    """{mediagate_id}.npy CLIP like embeddings (512 float32) for daily_count dailies with orders_per_daily orders each,
+    one order of each daily is similar to it.
+
+    Returns:
+        dict(daily_id : [order_ids])
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(clip_dir, exist_ok=True)
+    daily2order = {}
+    next_id = first_mediagate_id + 10**6
+    for _ in range(daily_count):
+        daily_id = next_id
+        daily = rng.normal(size=512).astype(np.float32)
+        np.save(os.path.join(clip_dir, f"{daily_id}.npy"), daily)
+        order_ids = list(range(daily_id+1, daily_id+1+orders_per_daily))
+        for i, order_id in enumerate(order_ids):
+            order = daily + rng.normal(scale=0.1, size=512).astype(np.float32) if i==0 else rng.normal(size=512).astype(np.float32)
+            np.save(os.path.join(clip_dir, f"{order_id}.npy"), order)
+        daily2order[daily_id] = order_ids
+        next_id += orders_per_daily+1
+    return daily2order
+
+
+class MediagateStub:
+    """Local http server with the MediagateDetails (POST {'ids': [...]}) and fileinfo (GET ?id=) endpoints.
+    Ids without a file get no MediagateDetails result and are answered with 404 by fileinfo, which ends
+    update_roi_latest after 100 of them. details(ids) replaces the MediagateDetails answer (list of results), if given."""
+
+    def __init__(self, files, details=None):
+        self.files = files
+        self.limit = max(files) if files else 0
+        self.details = details or self.file_details
+        self.details_requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                ids = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['ids']
+                stub.details_requests += 1
+                self.answer(200, {'Result': stub.details(ids)})
+
+            def do_GET(self):
+                file = stub.file(parse_qs(urlparse(self.path).query).get('id', [''])[0])
+                if file is None:
+                    self.answer(404, {'STATUS': 0, 'MESSAGE': 'not found'})
+                else:
+                    self.answer(200, {'IMAGE_PATH': file['image_path'], 'FILE_TYPE': 'repro', 'STATUS': 1, 'MESSAGE': ''})
+
+            def answer(self, status, content):
+                body = json.dumps(content).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def file_details(self, ids):
+        result = []
+        for mediagate_id in ids:
+            file = self.file(mediagate_id)
+            if file is not None: # no result for unknown ids, read_mediagate_infos has to split the request
+                result.append({'ENC_EBREITE': file['enc_wh'][0], 'ENC_EHOEHE': file['enc_wh'][1]})
+        return result
+
+    def file(self, mediagate_id):
+        try:
+            mediagate_id = int(mediagate_id)
+        except ValueError:
+            return None
+        if mediagate_id > self.limit:
+            return None
+        return self.files.get(mediagate_id)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def rss_mb():
+    """Resident set size of the process in MB ; None where it can't be read."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if platform.system()=='Darwin' else 2**10)
+    except ImportError:
+        return None
+
+
+class PeakMemory:
+    """Samples the resident set size every interval seconds in a thread, between __enter__ and __exit__.
+    Covers the memory of numpy and OpenCV as well (tracemalloc doesn't see OpenCV)."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.start = self.peak = rss_mb()
+        self.stop = threading.Event()
+
+    def sample(self):
+        while not self.stop.wait(self.interval):
+            rss = rss_mb()
+            if rss is not None and rss > self.peak:
+                self.peak = rss
+
+    def __enter__(self):
+        self.start = self.peak = rss_mb()
+        if self.start is not None:
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop.set()
+        if self.start is not None:
+            self.thread.join()
+            self.peak = max(self.peak, rss_mb())
+
+
+def run_stage(results, stage, size, items, function, verbose=False):
+    """Times function() and appends the measurements to results."""
+    gc.collect()
+    with open(os.devnull, 'w') as devnull:
+        with PeakMemory() as memory, redirect_stdout(sys.stdout if verbose else devnull), redirect_stderr(sys.stderr if verbose else devnull):
+            start = time.perf_counter()
+            function()
+            seconds = time.perf_counter() - start
+    result = {'stage': stage, 'size': size, 'items': items, 'seconds': round(seconds, 4),
+              'items_per_second': round(items/seconds, 3) if seconds > 0 else None,
+              'peak_rss_mb': None if memory.peak is None else round(memory.peak, 1),
+              'rss_increase_mb': None if memory.peak is None else round(memory.peak-memory.start, 1)}
+    results.append(result)
+    print(f"{stage:40s} size {size:6d} : {seconds:8.3f} s, {result['items_per_second']} items/s, peak {result['peak_rss_mb']} MB")
+    return result
+
+
+def use_stub(stub, share_dir):
+    """Points mediagate_client to the stub and maps the repro_files share to share_dir."""
+    mediagate_client.details_url = stub.url + '/MediagateDetails'
+    mediagate_client.fileinfo_url = stub.url + '/fileinfo'
+    mediagate_client.session = mediagate_client.create_session(retries=0)
+    mediagate_client.session.trust_env = False # no proxy for the stub
+    mediagate_client.response_cache = mediagate_client.ResponseCache(None)
+
+    original = use_stub.original = getattr(use_stub, 'original', update_dataset.mediagate_id_to_image_path)
+    def mediagate_id_to_image_path(mediagate_id):
+        image_path = original(mediagate_id)
+        if image_path is None:
+            return None
+        for share in ('/Netz/devarcsv041/orderdata/repro_files/', '//devarcsv041/orderdata/repro_files/'):
+            if image_path.startswith(share):
+                return share_dir + '/' + image_path[len(share):].lstrip('/')
+        return image_path
+    update_dataset.mediagate_id_to_image_path = mediagate_id_to_image_path
+
+
+def check_read_mediagate_infos():
+    """Checks the batched MediagateDetails lookup (mediagate_client.read_mediagate_infos) against stubs, that answer
+    with the results in shuffled order with their id, one result per id without ids, a gap in the middle of the
+    window and no results at all (a window past the frontier). Raises AssertionError on a wrong mapping."""
+    ids = [str(mediagate_id) for mediagate_id in range(first_mediagate_id+1, first_mediagate_id+41)]
+    gap = ids[17]
+    def info(mediagate_id):
+        return {'ENC_EBREITE': f"{mediagate_id}.0", 'ENC_EHOEHE': '100.0'}
+    cases = {
+        'shuffled_with_ids': (lambda window: [dict(info(i), MEDIAGATE_ID=int(i)) for i in reversed(window)], ids),
+        'one_per_id_without_ids': (lambda window: [info(i) for i in window], ids),
+        'gap_in_window': (lambda window: [info(i) for i in window if i != gap], [i for i in ids if i != gap]),
+        'past_frontier': (lambda window: [], []),
+    }
+    session, details_url, response_cache = mediagate_client.session, mediagate_client.details_url, mediagate_client.response_cache
+    mediagate_client.session = mediagate_client.create_session(retries=0)
+    mediagate_client.session.trust_env = False
+    mediagate_client.response_cache = mediagate_client.ResponseCache(None)
+    try:
+        for case, (details, expected_ids) in cases.items():
+            stub = MediagateStub({}, details)
+            mediagate_client.details_url = stub.url + '/MediagateDetails'
+            try:
+                mediagate_infos = mediagate_client.read_mediagate_infos(ids)
+            finally:
+                stub.close()
+            assert sorted(mediagate_infos) == sorted(expected_ids), (case, sorted(mediagate_infos))
+            for mediagate_id, mediagate_info in mediagate_infos.items():
+                assert mediagate_info['ENC_EBREITE'] == f"{mediagate_id}.0", (case, mediagate_id, mediagate_info)
+            assert stub.details_requests <= 2*len(ids).bit_length(), (case, stub.details_requests) # not id by id
+            print(f"{'read_mediagate_infos ' + case:40s} ok, {stub.details_requests} requests")
+    finally:
+        mediagate_client.session, mediagate_client.details_url, mediagate_client.response_cache = session, details_url, response_cache
+
+
+def reset_caches():
+    """Empties the in memory caches, so that each size starts cold (the path cache file is in the working directory)."""
+    path_resolver.listings.clear()
+    path_resolver.path_cache.clear()
+
+
+def benchmark(sizes, work_dir, dimension=2048, page_mm=page_mm, scan_workers=16, copy_workers=8, verbose=False):
+    """Runs every stage for every size.
+
+    Returns:
+        list of dict(stage, size, items, seconds, items_per_second, peak_rss_mb, rss_increase_mb)
+    """
+    results = []
+    share_dir = os.path.join(work_dir, 'repro_files')
+    clip_dir = os.path.join(work_dir, 'image_embeddings')
+    print(f"Generating {max(sizes)} synthetic repro files in {share_dir} ...")
+    files = generate_share(share_dir, max(sizes), page_mm)
+    daily2order_all = generate_embeddings(clip_dir, max(sizes))
+    stub = MediagateStub(files)
+    use_stub(stub, share_dir)
+
+    cwd = os.getcwd()
+    try:
+        for size in sizes:
+            run_dir = os.path.join(work_dir, f"run_{size}")
+            os.makedirs(run_dir)
+            os.chdir(run_dir)
+            reset_caches()
+            stub.limit = first_mediagate_id + size
+            mediagate_ids = list(range(first_mediagate_id+1, first_mediagate_id+1+size))
+
+            run_stage(results, 'update_roi_latest', size, size,
+                      lambda: update_dataset.update_roi_latest(first_mediagate_id, 0, workers=scan_workers), verbose)
+
+            image_dir = os.path.join(run_dir, 'images')
+            annotated = sum(1 for _ in open(update_dataset.annotation_log))
+            run_stage(results, 'fetch_images', size, annotated,
+                      lambda: fetch_images.fetch_images(image_dir, workers=copy_workers), verbose)
+
+            xml_paths = [os.path.join(share_dir, str(i), f"{i}.xml") for i in mediagate_ids]
+            run_stage(results, 'get_roi', size, size,
+                      lambda: [update_dataset.get_roi(xml_path) for xml_path in xml_paths], verbose)
+
+            image_paths = [os.path.join(share_dir, str(i), f"{i}_RAW.jpg") for i in mediagate_ids]
+            for reduced_decode in (False, True):
+                output_dir = os.path.join(run_dir, f"resized_{'reduced' if reduced_decode else 'full'}")
+                os.makedirs(output_dir)
+                run_stage(results, 'resize_and_write_image' + ('_reduced_decode' if reduced_decode else ''), size, size,
+                          lambda: [create_gaussian_dataset.resize_and_write_image(image_path, output_dir, dimension, reduced_decode=reduced_decode)
+                                   for image_path in image_paths], verbose)
+
+            gaussian_dir = os.path.join(run_dir, 'gaussian')
+            os.makedirs(gaussian_dir)
+            width, height = page_mm
+            rois_in_percent = [[files[i]['trim_mm'][0]/width, files[i]['trim_mm'][1]/height,
+                                files[i]['trim_mm'][2]/width, files[i]['trim_mm'][3]/height] for i in mediagate_ids]
+            run_stage(results, 'create_gaussian_image', size, size,
+                      lambda: [create_gaussian_dataset.create_gaussian_image(image_path, roi, gaussian_dir, dimension)
+                               for image_path, roi in zip(image_paths, rois_in_percent)], verbose)
+
+            daily2order = dict(list(daily2order_all.items())[:size])
+            run_stage(results, 'get_best_daily2order', size, size,
+                      lambda: prio_dataset.get_best_daily2order(daily2order, clip_dir + os.sep, index_path=None), verbose)
+
+            # prio: the trim box of the order found in the daily (here the same page)
+            pairs = []
+            for i in mediagate_ids[:min(size, 20)]:
+                x, y, w, h = [int(v/25.4*bench_dpi) for v in files[i]['trim_mm']]
+                pairs.append((os.path.join(share_dir, str(i), f"{i}.jpg"), [x, y, w//2, h//2]))
+            def match_pairs():
+                for image_path, roi in pairs:
+                    image = cv.imread(image_path, cv.IMREAD_COLOR)
+                    prio_dataset.match_template_pyramid(image, prio_dataset.get_cropped_order_image(image, roi))
+            run_stage(results, 'match_template_pyramid', size, len(pairs), match_pairs, verbose)
+
+            # correctness of the pyramid against the brute force match, on the pairs above and on random crops
+            rng = np.random.default_rng(size)
+            checks = []
+            for image_path, roi in pairs:
+                image = cv.imread(image_path, cv.IMREAD_COLOR)
+                height, width = image.shape[:2]
+                w, h = int(rng.integers(64, width//2)), int(rng.integers(64, height//2))
+                random_roi = [int(rng.integers(0, width-w)), int(rng.integers(0, height-h)), w, h]
+                for template_roi in (roi, random_roi):
+                    checks.append(prio_dataset.check_match_template_pyramid(image, prio_dataset.get_cropped_order_image(image, template_roi)))
+            check = {'stage': 'match_template_pyramid_check', 'size': size, 'items': len(checks),
+                     'same_location': sum(c['same_location'] for c in checks), 'agree': sum(c['agree'] for c in checks),
+                     'max_score_difference': round(max(c['score_difference'] for c in checks), 4)}
+            results.append(check)
+            print(f"{'match_template_pyramid_check':40s} size {size:6d} : {check['agree']}/{check['items']} agree with match_template "
+                  f"({check['same_location']} same location), max score difference {check['max_score_difference']}")
+    finally:
+        os.chdir(cwd)
+        stub.close()
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Offline benchmark of the pipeline stages on synthetic data")
+    parser.add_argument('-s','--sizes', nargs='+', type=int, default=[20, 100], required=False)
+    parser.add_argument('-r','--report', default="benchmark_report.json", required=False)
+    parser.add_argument('-d','--dimension', default=2048, type=int, required=False)
+    parser.add_argument('-w','--work_dir', default=None, required=False, help="kept after the run; a temporary directory is used and removed if not given")
+    parser.add_argument('--scan_workers', default=16, type=int, required=False)
+    parser.add_argument('--copy_workers', default=8, type=int, required=False)
+    parser.add_argument('-v','--verbose', action='store_true')
+    parser.add_argument('--check_only', action='store_true', help="only run the checks of the batched lookup")
+
+    args = parser.parse_args()
+
+    check_read_mediagate_infos()
+    if args.check_only:
+        sys.exit()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='roi_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        results = benchmark(sorted(args.sizes), os.path.abspath(work_dir), args.dimension,
+                            scan_workers=args.scan_workers, copy_workers=args.copy_workers, verbose=args.verbose)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(), 'platform': platform.platform(),
+              'cpu_count': os.cpu_count(), 'numpy': np.__version__, 'opencv': cv.__version__,
+              'arguments': vars(args), 'results': results}
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Report :", args.report)
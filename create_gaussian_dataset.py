@@ -1,13 +1,27 @@
+from annotation_store import RoiPercentStore, annotation_log, iter_annotations
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
 import cv2 as cv
+from fetch_images import read_manifest
+import hashlib
+import io
 import json
+import metrics
 import os
 import numpy as np
+import struct
+import tarfile
 from tqdm import tqdm
 
 image_dir = "/roi/latest_roi_repro" #"C:\\Users\\rislam\\Documents\\Python Scripts\\ROI\\images\\latest_roi_repro"
 dimension = 2048
 image_dir_dim = f"/roi/latest_roi_repro_{dimension}"
 gaussian_dir = f"/roi/latest_roi_repro_gaussian_{dimension}" #"C:\\Users\\rislam\\Documents\\Python Scripts\\ROI\\images\\gaussian_2048"
+render_workers = os.cpu_count() # processes for resizing and gaussian images
+reduced_decode = True # decode the jpegs at reduced size (>= dimension) before resizing, see compare_reduced_decode
+shard_dir = f"/roi/latest_roi_repro_shards_{dimension}" # packed training shards, see write_shards
+shard_size = 1024 # samples per shard
+pack_shards = False # pack the images into shard_dir after rendering (for training with roi_dataset.ShardDataset)
+render_manifest_name = '.render_manifest.jsonl' # in image_dir_dim, one line per rendered image
 
 
 point_per_inch = 300
@@ -15,25 +29,136 @@ inch_to_mm = 25.4
 point_to_mm = inch_to_mm/point_per_inch
 mm_to_pixel = point_per_inch/ inch_to_mm
 
+# 1-D kernel of cv.GaussianBlur(image, (5,5), 1) for uint8 images, in the fixed point (1/256) of its bit exact implementation
+gaussian_kernel = np.array([14, 62, 104, 62, 14], dtype=np.int64)
+
+sof_markers = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF} # start of frame, holds the image size
+
 # with open("images_and_roi10100.json") as f:
 #     images_and_roi = json.load(f) # in mm
 
 
-def resize_and_write_image(image_path, output_dir, dimension=2048):
+def read_jpeg_size(image_path):
+    """Reads the image size from the SOF segment of the jpeg header, without decoding the image.
+
+    Args:
+        image_path : path to the jpeg.
+
+    Returns:
+        (height, width) ; None if the file is no jpeg or has no SOF segment
+    """
+    with open(image_path, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return None
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            while marker[1] == 0xFF: # fill bytes
+                marker = marker[1:] + f.read(1)
+            if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD8: # markers without segment
+                continue
+            segment = f.read(2)
+            if len(segment) < 2:
+                return None
+            length = struct.unpack('>H', segment)[0]
+            if marker[1] in sof_markers:
+                _, height, width = struct.unpack('>BHH', f.read(5))
+                return height, width
+            f.seek(length-2, 1)
+
+
+def reduced_imread_flag(image_size, dimension=2048):
+    """Picks the largest jpeg decode reduction (1/2, 1/4, 1/8, done by libjpeg in the DCT domain) for which the
+    decoded image still has at least dimension pixels in both directions.
+
+    Args:
+        image_size : (height, width) of the full image.
+        dimension  : dimension, to which image will be resized
+
+    Returns:
+        cv.IMREAD_REDUCED_COLOR_8/4/2 or cv.IMREAD_COLOR
+    """
+    for factor, flag in ((8, cv.IMREAD_REDUCED_COLOR_8), (4, cv.IMREAD_REDUCED_COLOR_4), (2, cv.IMREAD_REDUCED_COLOR_2)):
+        if min(image_size)//factor >= dimension:
+            return flag
+    return cv.IMREAD_COLOR
+
+
+def read_image_for_resize(image_path, dimension=2048, image_size=None, reduced_decode=False):
+    """Decodes the image for resizing to dimension. With reduced_decode, the jpeg is decoded with the largest reduction
+    of reduced_imread_flag, which takes a fraction of the time and memory of the full decode."""
+    if not reduced_decode:
+        return cv.imread(image_path, cv.IMREAD_COLOR)
+    if image_size is None:
+        image_size = read_jpeg_size(image_path)
+    if image_size is None:
+        return cv.imread(image_path, cv.IMREAD_COLOR)
+    return cv.imread(image_path, reduced_imread_flag(image_size, dimension))
+
+
+def compare_reduced_decode(image_paths, dimension=2048):
+    """Quality check of the reduced decode: resizes each image with the full decode and with the reduced decode
+    and compares both results.
+
+    Args:
+        image_paths : paths to jpegs.
+        dimension   : dimension, to which the images are resized
+
+    Returns:
+        list of dict(image_path, psnr, max_abs_diff, mean_abs_diff) ; psnr is inf for identical results
+    """
+    comparison = []
+    for image_path in image_paths:
+        full = cv.resize(read_image_for_resize(image_path, dimension), (dimension,dimension))
+        reduced = cv.resize(read_image_for_resize(image_path, dimension, reduced_decode=True), (dimension,dimension))
+        abs_diff = cv.absdiff(full, reduced)
+        comparison.append({'image_path': image_path,
+                           'psnr': cv.PSNR(full, reduced),
+                           'max_abs_diff': int(abs_diff.max()),
+                           'mean_abs_diff': float(abs_diff.mean())})
+    return comparison
+
+
+def resize_and_write_image(image_path, output_dir, dimension=2048, image=None, image_size=None, reduced_decode=False):
+    """Reads an image from path, resizes the image according to the given dimension and saves it to the output_dir.
+
+    Args:
+        image_path     : path to the image.
+        output_dir     : directory, where the images will be saved.
+        dimension      : dimension, to which image will be resized
+        image          : already decoded image (cv.IMREAD_COLOR), read from image_path if None.
+        image_size     : (height, width) of the image, if already known (for reduced_decode).
+        reduced_decode : decode the jpeg at 1/2, 1/4 or 1/8 size, as long as that is still >= dimension (see reduced_imread_flag).
+
+    Returns:
+        Bool : True is successfull, False otherwise
+    """
     dest_path = os.path.join(output_dir, os.path.basename(image_path))
     try:
         if os.path.exists(dest_path):
+            metrics.count('resize_skipped_existing')
             return True
-        image = cv.imread(image_path, cv.IMREAD_COLOR)
-        reduced_image = cv.resize(image, (dimension,dimension))
-        cv.imwrite(dest_path,reduced_image)
+        if image is None:
+            with metrics.timed('jpeg_decode'):
+                image = read_image_for_resize(image_path, dimension, image_size, reduced_decode)
+            metrics.add_bytes('jpeg_read', os.path.getsize(image_path))
+        with metrics.timed('resize'):
+            reduced_image = cv.resize(image, (dimension,dimension))
+        with metrics.timed('jpeg_encode'):
+            cv.imwrite(dest_path,reduced_image)
+        metrics.add_bytes('jpeg_write', os.path.getsize(dest_path))
+        metrics.count('resized')
         return True
     except Exception as e:
         print(e.__class__)
+        metrics.count('resize_error')
         return False
 
 
-def create_gaussian_image(image_path, xywh, output_dir, dimension=2048):
+def blur_gaussian_target(xywh, dimension=2048):
+    """Reference implementation of the gaussian target: draws the rectangle on a (dimension x dimension) array
+    and blurs the whole array. render_gaussian_target gives the same result and uses this for degenerate rectangles."""
     x,y,w,h = [int(i*dimension) for i in xywh]
     black = np.zeros((dimension, dimension), dtype= np.uint8)
     if (x+w>=(dimension-1)):
@@ -44,63 +169,441 @@ def create_gaussian_image(image_path, xywh, output_dir, dimension=2048):
     black[y+1:y+h,x+1:x+w] = 0
     black = cv.GaussianBlur(black, (5,5),1)
     black = ((black.astype(np.float16)/black.max())*255).astype(np.uint8)
+    return black
 
-    cv.imwrite(os.path.join(output_dir, os.path.basename(image_path)), black)
 
-if __name__ == "__main__":
+def blur_1d(vector):
+    """Convolves an int vector with gaussian_kernel, border like cv.BORDER_REFLECT_101."""
+    return np.convolve(np.pad(vector, 2, mode='reflect'), gaussian_kernel, mode='valid')
 
-    with open('last_scan.json') as f:
-        last_scan = json.load(f)
 
-    roi_count = last_scan['roi_count']
+def render_gaussian_target(xywh, dimension=2048, out=None):
+    """Same result as blur_gaussian_target, but only the rows and columns around the rectangle are computed.
+    The outline is split into 4 line segments, the blur of each segment is the outer product of two 1-D blurred vectors.
+    The fixed point arithmetic of cv.GaussianBlur is reproduced, so the result is identical.
 
-    with open(f'images_and_roi{roi_count}.json') as f:
-        images_and_roi_mm = json.load(f)
+    Args:
+        xywh      : A list with [x,y,w,h] in percent of the image size.
+        dimension : The size of the array/image
+        out       : (dimension x dimension) uint8 array filled with zeros to render into; allocated if None.
 
-    if os.path.exists("images_roi_percent_latest.json"):
-        with open("images_roi_percent_latest.json") as f:
-            local_images_roi_percentage_dict = json.load(f)
+    Returns:
+        out
+    """
+    x,y,w,h = [int(i*dimension) for i in xywh]
+    if (x+w>=(dimension-1)):
+        w = dimension-x-2
+    if (y+h>=(dimension-1)):
+        h = dimension-y-2
+    if out is None:
+        out = np.zeros((dimension, dimension), dtype= np.uint8)
+    if min(x,y,w,h)<0:
+        out[:] = blur_gaussian_target(xywh, dimension)
+        return out
+
+    # top row, bottom row, left column, right column (the columns without the corners)
+    rows = np.zeros((4, dimension), dtype=np.int64)
+    cols = np.zeros((4, dimension), dtype=np.int64)
+    rows[0, y] = 1
+    cols[0, x:x+w+1] = 1
+    if h>0:
+        rows[1, y+h] = 1
+        cols[1, x:x+w+1] = 1
+    if h>1:
+        rows[2, y+1:y+h] = 1
+        cols[2, x] = 1
+        if w>0:
+            rows[3, y+1:y+h] = 1
+            cols[3, x+w] = 1
+    rows = np.array([blur_1d(row) for row in rows]) * 255
+    cols = np.array([blur_1d(col) for col in cols])
+
+    # everything else stays 0
+    band_rows = sorted(set(range(max(y-2,0), min(y+3,dimension))) | set(range(max(y+h-2,0), min(y+h+3,dimension))))
+    band_cols = sorted(set(range(max(x-2,0), min(x+3,dimension))) | set(range(max(x+w-2,0), min(x+w+3,dimension))))
+    row_strip = ((rows[:, band_rows].T @ cols + 32768) >> 16).astype(np.uint8)
+    col_strip = ((rows.T @ cols[:, band_cols] + 32768) >> 16).astype(np.uint8)
+    maximum = max(row_strip.max(), col_strip.max())
+
+    out[band_rows, :] = ((row_strip.astype(np.float16)/maximum)*255).astype(np.uint8)
+    out[:, band_cols] = ((col_strip.astype(np.float16)/maximum)*255).astype(np.uint8)
+    return out
+
+
+def render_gaussian_targets(xywhs, dimension=2048, out=None):
+    """Batch version of render_gaussian_target, renders all targets into one (n x dimension x dimension) uint8 buffer.
+
+    Args:
+        xywhs     : list of [x,y,w,h] in percent of the image size.
+        dimension : The size of the arrays/images
+        out       : buffer to reuse, at least len(xywhs) targets big; allocated if None.
+
+    Returns:
+        out[:len(xywhs)]
+    """
+    if out is None:
+        out = np.zeros((len(xywhs), dimension, dimension), dtype= np.uint8)
     else:
-        local_images_roi_percentage_dict = {}
+        out = out[:len(xywhs)]
+        out[:] = 0
+    for target, xywh in zip(out, xywhs):
+        render_gaussian_target(xywh, dimension, target)
+    return out
+
 
-    local_images_roi_percentage_dict_keys = local_images_roi_percentage_dict.keys()
+def create_gaussian_image(image_path, xywh, output_dir, dimension=2048):
+    """Creates a numpy array in the shape of (dimension x dimension) with zeros.
+    The rectangle corresponding region of interest has 255. We apply gaussian blur, because the in the real image
+    the lines represent gaussian distribution. Normalize the blurred image so that maximum is 255.
+    (see render_gaussian_target)
+
+    Args:
+        image_path : uses this path just to save the image with this name, doesn't read the original image.
+        xywh : A list with [x,y,w,h]; the dimensions are in pixels.
+        output_dir : Directory to save the gaussian array/images.
+        dimension : The size of the array/image
+
+    Returns:
+        None
+    """
+    with metrics.timed('gaussian_render'):
+        black = render_gaussian_target(xywh, dimension)
+
+    with metrics.timed('gaussian_encode'):
+        cv.imwrite(os.path.join(output_dir, os.path.basename(image_path)), black)
+
+
+def resize_and_gaussian_image(local_image_path, roi_mm, image_dir_dim, gaussian_dir, dimension=2048, reduced_decode=False):
+    """Writes the resized image and the gaussian image for one image. Runs in the worker processes of resized_and_gaussian_images.
+
+    Args:
+        local_image_path : path of the copied image.
+        roi_mm           : [x,y,w,h] in mm.
+        image_dir_dim    : directory for the resized image.
+        gaussian_dir     : directory for the gaussian image, None writes no gaussian image.
+        dimension        : size of the resized and the gaussian image.
+        reduced_decode   : see resize_and_write_image.
+
+    Returns:
+        roi_in_percent if successfull, None otherwise
+    """
+    try:
+        # the size comes from the jpeg header, the image is only decoded (once) if it still has to be resized
+        image = None
+        image_size = read_jpeg_size(local_image_path)
+        if image_size is None:
+            with metrics.timed('jpeg_decode'):
+                image = cv.imread(local_image_path, cv.IMREAD_COLOR)
+            image_size = image.shape[:2]
+        image_height, image_width = image_size
+        roi_pixel = [roi*mm_to_pixel for roi in roi_mm]
+        roi_in_percent = [roi_pixel[0]/image_width, roi_pixel[1]/image_height, roi_pixel[2]/image_width, roi_pixel[3]/image_height]
+        if not resize_and_write_image(local_image_path, image_dir_dim, dimension, image, image_size, reduced_decode):
+            return None
+        if gaussian_dir is not None:
+            create_gaussian_image(local_image_path,roi_in_percent, gaussian_dir, dimension)
+        return roi_in_percent
+    except Exception as e:
+        print("Error : ",e.__class__)
+        metrics.count('render_error')
+        return None
 
-    if not os.path.exists(gaussian_dir):
+
+def render_keys(source, roi_mm, dimension, reduced_decode, gaussian):
+    """Keys of a rendered image in the render manifest.
+
+    Args:
+        source : dict with size and mtime of the image (from the fetch manifest).
+        roi_mm, dimension, reduced_decode : see resize_and_gaussian_image.
+        gaussian : True if a gaussian image is written.
+
+    Returns:
+        (image_key, key) ; image_key changes with the source and the resize parameters (the resized image has to be
+        written again), key also with the roi and the gaussian image
+    """
+    image_key = hashlib.sha1(json.dumps([source['size'], source['mtime'], dimension, reduced_decode]).encode()).hexdigest()[:16]
+    key = hashlib.sha1(json.dumps([image_key, roi_mm, gaussian]).encode()).hexdigest()[:16]
+    return image_key, key
+
+
+def resized_and_gaussian_images(image_dir, image_dir_dim, gaussian_dir, dimension=2048, annotation_path=annotation_log, workers=1, reduced_decode=False, verify=False):
+    """For every annotated image in image_dir writes the resized image to image_dir_dim and the gaussian image to gaussian_dir.
+    The images are processed by a pool of workers processes, the roi in percent of the image size is collected in this
+    process and kept in images_roi_percent_latest.json.
+
+    Rendered images are recorded in the render manifest of image_dir_dim with keys of their source (size and mtime from
+    the fetch manifest), roi and output parameters (see render_keys). An annotation with the keys of the manifest is
+    skipped without touching the disk, only new or changed ones are rendered. Images rendered before there was a
+    manifest are checked on disk once and added to it.
+
+    Args:
+        image_dir       : directory with the copied images.
+        image_dir_dim   : directory for the resized images.
+        gaussian_dir    : directory for the gaussian images; None writes no gaussian images,
+                          roi_dataset.RoiDataset renders the targets from the roi in percent at read time.
+        dimension       : size of the resized and the gaussian images.
+        annotation_path : annotation log written by update_roi_latest.
+        workers         : number of worker processes; 1 processes the images in this process.
+        reduced_decode  : see resize_and_write_image.
+        verify          : also check that the outputs of unchanged images exist, and render the missing ones.
+
+    Returns:
+        None
+    """
+    local_images_roi_percentage_dict = RoiPercentStore("images_roi_percent_latest.json")
+    fetched = read_manifest(image_dir)
+    rendered = read_manifest(image_dir_dim, render_manifest_name)
+
+    if gaussian_dir is not None and not os.path.exists(gaussian_dir):
         os.makedirs(gaussian_dir)
 
     if not os.path.exists(image_dir_dim):
         os.makedirs(image_dir_dim)
-    
 
-    for image_path, roi_mm in tqdm(images_and_roi_mm.items()):
-        local_image_path = os.path.join(image_dir, os.path.basename(image_path))
-        if not os.path.exists(local_image_path):
-            continue
-        if local_image_path in local_images_roi_percentage_dict_keys:
-            if (os.path.exists(os.path.join(image_dir_dim, os.path.basename(local_image_path))) and os.path.exists(os.path.join(gaussian_dir, os.path.basename(local_image_path)))):
+    manifest_file = open(os.path.join(image_dir_dim, render_manifest_name), 'a')
+
+    def record(render_record):
+        rendered[render_record['name']] = render_record
+        manifest_file.write(json.dumps(render_record) + '\n')
+
+    def merge(local_image_path, roi_in_percent, render_record):
+        metrics.count('render_failed' if roi_in_percent is None else 'render_done')
+        if roi_in_percent is None:
+            local_images_roi_percentage_dict.pop(local_image_path)
+        else:
+            local_images_roi_percentage_dict.update(local_image_path, roi_in_percent)
+            record(render_record)
+
+    executor = None
+    if workers>1:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=cv.setNumThreads, initargs=(1,))
+    pending = {}
+    # dict(local_image_path : roi_mm), the last annotation of an image counts, like load_annotations
+    annotations = {os.path.join(image_dir, os.path.basename(image_path)): roi_mm for _, image_path, roi_mm in iter_annotations(annotation_path)}
+
+    try:
+        for local_image_path, roi_mm in tqdm(annotations.items()):
+            name = os.path.basename(local_image_path)
+
+            source = fetched.get(name)
+            if source is None: # not copied by fetch_images
+                if not os.path.exists(local_image_path):
+                    continue
+                source_stat = os.stat(local_image_path)
+                source = {'size': source_stat.st_size, 'mtime': source_stat.st_mtime}
+            image_key, key = render_keys(source, roi_mm, dimension, reduced_decode, gaussian_dir is not None)
+            render_record = {'name': name, 'image_key': image_key, 'key': key}
+            previous = rendered.get(name)
+
+            unchanged = previous is not None and previous['key'] == key and local_image_path in local_images_roi_percentage_dict
+            if unchanged and not verify:
+                metrics.count('render_unchanged')
                 continue
-        try:
-            image = cv.imread(local_image_path,-1)
-            image_height, image_width, _ = image.shape
-            roi_pixel = [roi*mm_to_pixel for roi in roi_mm]
-            roi_in_percent = [roi_pixel[0]/image_width, roi_pixel[1]/image_height, roi_pixel[2]/image_width, roi_pixel[3]/image_height]
-            if not resize_and_write_image(local_image_path, image_dir_dim, dimension):
-                if local_image_path in local_images_roi_percentage_dict:
-                    local_images_roi_percentage_dict.pop(local_image_path, None)
+            if not os.path.exists(local_image_path):
                 continue
-            create_gaussian_image(local_image_path,roi_in_percent, gaussian_dir, dimension)
+            if (unchanged or previous is None) and local_image_path in local_images_roi_percentage_dict:
+                if (os.path.exists(os.path.join(image_dir_dim, name)) and (gaussian_dir is None or os.path.exists(os.path.join(gaussian_dir, name)))):
+                    metrics.count('render_skipped')
+                    if previous is None:
+                        record(render_record)
+                    continue
+            if previous is not None and previous['image_key'] != image_key and os.path.exists(os.path.join(image_dir_dim, name)):
+                os.remove(os.path.join(image_dir_dim, name)) # changed source or resize parameters, resize_and_write_image keeps existing images
+
+            if executor is None:
+                merge(local_image_path, resize_and_gaussian_image(local_image_path, roi_mm, image_dir_dim, gaussian_dir, dimension, reduced_decode), render_record)
+                continue
+
+            future = executor.submit(metrics.collected, resize_and_gaussian_image, local_image_path, roi_mm, image_dir_dim, gaussian_dir, dimension, reduced_decode)
+            pending[future] = (local_image_path, render_record)
+            if len(pending)>=2*workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    roi_in_percent, worker_metrics = future.result()
+                    metrics.merge(worker_metrics)
+                    local_image_path, render_record = pending.pop(future)
+                    merge(local_image_path, roi_in_percent, render_record)
 
-            local_images_roi_percentage_dict.update({local_image_path:roi_in_percent})
-        except Exception as e:
-            print("Error : ",e.__class__)
-            if local_image_path in local_images_roi_percentage_dict:
-                local_images_roi_percentage_dict.pop(local_image_path, None)
+        for future in as_completed(pending):
+            roi_in_percent, worker_metrics = future.result()
+            metrics.merge(worker_metrics)
+            local_image_path, render_record = pending[future]
+            merge(local_image_path, roi_in_percent, render_record)
+        pending = {}
+    finally:
+        if executor is not None:
+            for future in pending:
+                future.cancel()
+            executor.shutdown()
+        manifest_file.close()
+        with metrics.timed('json_dump'):
+            local_images_roi_percentage_dict.commit()
 
-        with open("images_roi_percent_latest.json",'w') as f:
-            json.dump(local_images_roi_percentage_dict,f)
 
+def write_tar_shard(shard_path, members):
+    """Writes (name, bytes) members to an uncompressed tar and returns dict(name : (offset, size)) of their data in the file."""
+    offsets = {}
+    with tarfile.open(shard_path + '.tmp', 'w') as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+            padded_size = -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE # data is padded to full blocks
+            offsets[name] = (tar.offset - padded_size, len(data))
+    os.replace(shard_path + '.tmp', shard_path)
+    return offsets
 
 
+def write_npy_shard(shard_path, shape, fill):
+    """Writes a uint8 .npy of shape, which np.load(..., mmap_mode='r') maps without reading. The file is memory mapped
+    while it is written and fill(i, row) writes sample i straight into its (zeroed) row, so only one sample at a time
+    is in memory, not the whole shard."""
+    shard = np.lib.format.open_memmap(shard_path + '.tmp', mode='w+', dtype=np.uint8, shape=shape)
+    for i in range(shape[0]):
+        fill(i, shard[i])
+    shard.flush()
+    del shard
+    os.replace(shard_path + '.tmp', shard_path)
 
 
+def shard_file_names(index_format, shard_name):
+    """Files of a shard in the shard directory."""
+    if index_format == 'npy':
+        return [f"images-{shard_name}.npy", f"targets-{shard_name}.npy"]
+    return [f"images-{shard_name}.tar"]
+
+
+def write_shards(image_dir_dim, shard_dir, dimension=2048, shard_size=1024, roi_percent_path="images_roi_percent_latest.json", gaussian_dir=None, raw=False):
+    """Packs the resized images (and gaussian targets) into a few big shard files with an index, so that training
+    reads them by offset from memory mapped files instead of opening tens of thousands of small files.
+
+    Two formats:
+        raw=False : tar shards (images-<name>.tar, ...) with the jpegs of image_dir_dim as they are, and the jpegs of
+                    gaussian_dir if given. The index keeps the offset and size of every file in its tar, a reader
+                    decodes the bytes straight from the memory map (cv.imdecode). About as big as the jpegs.
+        raw=True  : .npy shards with the decoded uint8 arrays, images-<name>.npy (n x dimension x dimension x 3) and
+                    targets-<name>.npy (n x dimension x dimension, rendered with render_gaussian_target). A reader gets
+                    the arrays without any decoding or copy. Needs dimension*dimension*4 bytes per sample.
+
+    The build is incremental: full shards of the last index, whose samples are all unchanged (same roi, same size and
+    mtime of the image files), are kept. Only the other samples are packed, into new shards. Shard names are hashes
+    of their content, so a shard file is never overwritten; the new index.json is swapped in atomically when all its
+    shards are written. Shards of the previous index stay for one more run (for readers that still use it), older
+    ones are removed.
+
+    Args:
+        image_dir_dim    : directory with the resized images.
+        shard_dir        : output directory, index.json and the shards.
+        dimension        : size of the images in the shards; images of another size are resized (raw=True only).
+        shard_size       : samples per shard.
+        roi_percent_path : json with dict(local_image_path : roi_in_percent).
+        gaussian_dir     : directory with the gaussian images to pack (raw=False); None packs no targets,
+                           roi_dataset.ShardDataset renders them from the roi in percent.
+        raw              : see above.
+
+    Returns:
+        number of packed samples
+    """
+    index_format = 'npy' if raw else 'tar'
+    with open(roi_percent_path) as f:
+        roi_percent = json.load(f)
+    samples = {}
+    for image_path, roi_in_percent in roi_percent.items():
+        name = os.path.basename(image_path)
+        try:
+            image_stat = os.stat(os.path.join(image_dir_dim, name))
+            source = [image_stat.st_size, image_stat.st_mtime_ns]
+            if gaussian_dir is not None and not raw:
+                target_stat = os.stat(os.path.join(gaussian_dir, name))
+                source += [target_stat.st_size, target_stat.st_mtime_ns]
+        except FileNotFoundError:
+            continue
+        samples[name] = {'name': name, 'roi_in_percent': roi_in_percent, 'source': source}
+
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    index_path = os.path.join(shard_dir, 'index.json')
+    previous = None
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            previous = json.load(f)
+        if previous['format'] != index_format or previous['dimension'] != dimension or previous.get('gaussian') != (gaussian_dir is not None):
+            previous = None
+
+    index = {'format': index_format, 'dimension': dimension, 'gaussian': gaussian_dir is not None, 'shards': [], 'samples': []}
+    packed = set()
+    if previous is not None:
+        previous_shards = {}
+        for sample in previous['samples']:
+            previous_shards.setdefault(sample['shard'], []).append(sample)
+        for shard_name in previous['shards']:
+            shard_samples = previous_shards.get(shard_name, [])
+            unchanged = all(sample['name'] in samples and sample['name'] not in packed
+                            and samples[sample['name']]['roi_in_percent'] == sample['roi_in_percent']
+                            and samples[sample['name']]['source'] == sample['source'] for sample in shard_samples)
+            if unchanged and len(shard_samples) == shard_size:
+                index['shards'].append(shard_name)
+                index['samples'] += shard_samples
+                packed.update(sample['name'] for sample in shard_samples)
+                metrics.count('shard_kept')
+
+    todo = [sample for name, sample in samples.items() if name not in packed]
+    for start in tqdm(range(0, len(todo), shard_size)):
+        shard_samples = todo[start:start+shard_size]
+        shard_name = hashlib.sha1(json.dumps([index_format, dimension, shard_samples]).encode()).hexdigest()[:16]
+        metrics.count('shard_written')
+
+        if raw:
+            def read_image(i, row):
+                image = cv.imread(os.path.join(image_dir_dim, shard_samples[i]['name']), cv.IMREAD_COLOR)
+                if image.shape[:2] != (dimension, dimension):
+                    image = cv.resize(image, (dimension, dimension), interpolation=cv.INTER_AREA)
+                row[:] = image
+
+            write_npy_shard(os.path.join(shard_dir, f"images-{shard_name}.npy"), (len(shard_samples), dimension, dimension, 3), read_image)
+            write_npy_shard(os.path.join(shard_dir, f"targets-{shard_name}.npy"), (len(shard_samples), dimension, dimension),
+                            lambda i, row: render_gaussian_target(shard_samples[i]['roi_in_percent'], dimension, row))
+            index['shards'].append(shard_name)
+            for row, sample in enumerate(shard_samples):
+                index['samples'].append(dict(sample, shard=shard_name, row=row))
+            continue
+
+        def members():
+            for sample in shard_samples:
+                with open(os.path.join(image_dir_dim, sample['name']), 'rb') as f:
+                    yield 'images/' + sample['name'], f.read()
+                if gaussian_dir is not None:
+                    with open(os.path.join(gaussian_dir, sample['name']), 'rb') as f:
+                        yield 'targets/' + sample['name'], f.read()
+
+        offsets = write_tar_shard(os.path.join(shard_dir, f"images-{shard_name}.tar"), members())
+        index['shards'].append(shard_name)
+        for sample in shard_samples:
+            index['samples'].append(dict(sample, shard=shard_name, image=offsets['images/' + sample['name']],
+                                         target=offsets.get('targets/' + sample['name'])))
+
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(index_path + '.tmp', index_path)
+
+    in_use = {file_name for shard_name in index['shards'] for file_name in shard_file_names(index_format, shard_name)}
+    if previous is not None:
+        in_use.update(file_name for shard_name in previous['shards'] for file_name in shard_file_names(previous['format'], shard_name))
+    for file_name in os.listdir(shard_dir):
+        if file_name.startswith(('images-', 'targets-')) and file_name not in in_use:
+            os.remove(os.path.join(shard_dir, file_name))
+    return len(index['samples'])
+
+
+if __name__ == "__main__":
 
+    with metrics.profiled():
+        with metrics.timed('resized_and_gaussian_images'):
+            resized_and_gaussian_images(image_dir, image_dir_dim, gaussian_dir, dimension, workers=render_workers, reduced_decode=reduced_decode)
+        if pack_shards:
+            with metrics.timed('write_shards'):
+                write_shards(image_dir_dim, shard_dir, dimension, shard_size, gaussian_dir=gaussian_dir)
+    metrics.write_textfile()
@@ -1,47 +1,140 @@
+from annotation_store import annotation_log, iter_annotations
 import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 import json
+import metrics
 import os
 import shutil
 from tqdm import tqdm
 
 
-if __name__=="__main__":
+manifest_name = '.fetch_manifest.jsonl' # in the image directory, one line per copied image
 
-    parser = argparse.ArgumentParser(description="Arguments to prepare the dataset")
-    parser.add_argument('-i','--image_dir', default="/roi/latest_roi_repro", required=False)
 
+def read_manifest(image_dir, name=manifest_name):
+    """Returns dict(image name : {'source', 'size', 'mtime'}) of the images copied to image_dir.
+    With name, reads another manifest of the same format (one json record with a 'name' per line, the last one counts)."""
+    manifest = {}
+    manifest_path = os.path.join(image_dir, name)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                record = json.loads(line)
+                manifest[record['name']] = record
+    return manifest
 
-    args = parser.parse_args()
-    image_dir = args.image_dir
+
+def copy_image(source_image_path, dest_image_path, keep_existing=True):
+    """Copies one image from the share. The copy is written to a temporary file and renamed, so an
+    interrupted copy never leaves a truncated image behind. With keep_existing, an existing image that
+    isn't in the manifest (copied before there was one) is kept, if it has the size of the source.
+
+    Returns:
+        dict(name, source, size, mtime) of the copied image; None if the source doesn't exist
+    """
+    try:
+        with metrics.timed('share_stat'):
+            source_stat = os.stat(source_image_path)
+    except FileNotFoundError:
+        if source_image_path.endswith('.jpg'):
+            source_image_path = source_image_path.replace('.jpg','.jpeg')
+        elif source_image_path.endswith('.jpeg'):
+            source_image_path = source_image_path.replace('.jpeg','.jpg')
+        try:
+            with metrics.timed('share_stat'):
+                source_stat = os.stat(source_image_path)
+        except FileNotFoundError:
+            metrics.count('fetch_missing')
+            return None
+
+    record = {'name': os.path.basename(dest_image_path), 'source': source_image_path,
+              'size': source_stat.st_size, 'mtime': source_stat.st_mtime}
+    if keep_existing and os.path.exists(dest_image_path) and os.path.getsize(dest_image_path) == source_stat.st_size:
+        metrics.count('fetch_existing')
+        return record
+
+    part_path = dest_image_path + '.part'
+    with metrics.timed('copy_image'):
+        shutil.copy(source_image_path, part_path)
+    os.replace(part_path, dest_image_path)
+    metrics.add_bytes('copy_image', source_stat.st_size)
+    metrics.count('fetch_copied')
+    return record
+
+
+def fetch_images(image_dir, annotation_path=annotation_log, workers=8):
+    """Reads the paths from the annotation log and copies each image in image dir, with workers concurrent copies.
+    Images of the same name are copied once, from the path of the last annotation (as with load_annotations).
+    Copied images are recorded (source, size, mtime) in the manifest of image_dir; these are skipped on
+    the next run without touching the share, unless the last annotation points to another source.
+
+    Args:
+        image_dir       : directory, where the images will be copied.
+        annotation_path : annotation log written by update_roi_latest.
+        workers         : number of concurrent copies.
+
+    Returns:
+        None
+    """
 
     if not os.path.exists(image_dir):
         os.makedirs(image_dir)
 
-    with open('last_scan.json') as f:
-        last_scan = json.load(f)
+    manifest = read_manifest(image_dir)
+    # dict(dest_image_path : source_image_path), the last annotation of an image name counts, like load_annotations
+    sources = {os.path.join(image_dir, os.path.basename(source_image_path)): source_image_path
+               for _, source_image_path, _ in iter_annotations(annotation_path)}
+    pending = {}
 
-    roi_count = last_scan['roi_count']
-    
-    with open(f'images_and_roi{roi_count}.json') as f:
-        images_and_annotation = json.load(f)
+    with ThreadPoolExecutor(max_workers=workers) as executor, open(os.path.join(image_dir, manifest_name), 'a') as manifest_file:
 
+        def record(future):
+            try:
+                copied = future.result()
+            except Exception as e:
+                print("Error!", e.__class__, "occurred.")
+                metrics.count('fetch_error')
+                return
+            if copied is not None:
+                manifest[copied['name']] = copied
+                manifest_file.write(json.dumps(copied) + '\n')
+                manifest_file.flush()
 
-    for source_image_path in tqdm(images_and_annotation.keys()):
-        dest_image_path = os.path.join(image_dir,os.path.basename(source_image_path))
-        if not os.path.exists(dest_image_path):
-            if not os.path.exists(source_image_path):
-                if source_image_path.endswith('.jpg'):
-                    source_image_path = source_image_path.replace('.jpg','.jpeg')
-                elif source_image_path.endswith('.jpeg'):
-                    source_image_path = source_image_path.replace('.jpeg','.jpg')
-                if not os.path.exists(source_image_path):
-                    continue
-            
-            shutil.copy(source_image_path, dest_image_path)
-        # print(count)
+        for dest_image_path, source_image_path in tqdm(sources.items()):
+            recorded = manifest.get(os.path.basename(dest_image_path))
+            same_source = recorded is not None and os.path.splitext(recorded['source'])[0] == os.path.splitext(source_image_path)[0]
+            if same_source and os.path.exists(dest_image_path):
+                metrics.count('fetch_skipped')
+                continue
 
-    os.system("python create_gaussian_dataset.py")  
+            pending[executor.submit(copy_image, source_image_path, dest_image_path, recorded is None)] = dest_image_path
+            if len(pending)>=4*workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.pop(future)
+                    record(future)
 
-    print("!")
+        for future in as_completed(pending):
+            record(future)
+
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser(description="Arguments to prepare the dataset")
+    parser.add_argument('-i','--image_dir', default="/roi/latest_roi_repro", required=False)
+    parser.add_argument('-a','--annotation_log', default=annotation_log, required=False)
+    parser.add_argument('-w','--workers', default=8, type=int, required=False)
+
+
+    args = parser.parse_args()
+
+    with metrics.profiled():
+        with metrics.timed('fetch_images'):
+            fetch_images(args.image_dir, args.annotation_log, args.workers)
+    metrics.write_textfile()
 
+    os.system("python create_gaussian_dataset.py")
 
+    print("!")
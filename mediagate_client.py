@@ -0,0 +1,246 @@
+import json
+import metrics
+import os
+import requests
+import sqlite3
+import threading
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+details_url = 'https://api.saueressig.de/MediagateAPI/MediagateDetails'
+fileinfo_url = 'http://devwebvm087.saueressig.de/mediagate/public/clynx/fileinfo'
+auth = ('web2gravure', '5#dlKjgjAwh!!')
+
+timeout = (5, 30) # (connect, read) in seconds
+pool_size = 32 # keep-alive connections per host, enough for the scan workers
+
+details_id_fields = ('MEDIAGATE_ID', 'ID', 'Id', 'id') # fields of a MediagateDetails result that may name its mediagate id
+
+cache_path = 'mediagate_cache.sqlite'
+cache_ttl = 30*24*3600 # seconds, cached responses older than this are fetched again
+
+
+def create_session(retries=5, backoff_factor=0.5):
+    """Creates a requests session with connection pooling (keep-alive) and retries with exponential backoff.
+    Connection errors, read errors and 5xx answers are retried, for GET and POST.
+
+    Args:
+        retries        : maximum number of retries per request.
+        backoff_factor : sleep between retries is backoff_factor * 2**(retry-1) seconds.
+
+    Returns:
+        requests.Session
+    """
+    retry = Retry(total=retries, connect=retries, read=retries, status=retries,
+                  backoff_factor=backoff_factor, status_forcelist=(500, 502, 503, 504),
+                  allowed_methods=None, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+session = create_session()
+
+
+def post(url, **kwargs):
+    kwargs.setdefault('timeout', timeout)
+    response = session.post(url, **kwargs)
+    response.raise_for_status()
+    return response
+
+
+def get(url, **kwargs):
+    kwargs.setdefault('timeout', timeout)
+    response = session.get(url, **kwargs)
+    response.raise_for_status()
+    return response
+
+
+class ResponseCache:
+    """Persistent cache of the MediagateDetails and fileinfo answers in sqlite, keyed by endpoint and mediagate id.
+    These hardly ever change, so reruns can answer almost every lookup without a network call.
+    Safe to use from several threads.
+
+    Args:
+        path : sqlite file; None disables the cache.
+        ttl  : seconds, after which a cached answer is fetched again.
+    """
+
+    def __init__(self, path=cache_path, ttl=cache_ttl):
+        self.path = path
+        self.ttl = ttl
+        self.reopen()
+
+    def reopen(self):
+        """Drops the connection, needed in a forked worker process (a sqlite connection can't be shared with it);
+        a new one is opened on the next use."""
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def connect(self):
+        """The sqlite connection, opened on first use (with self.lock held), so that importing the module creates no file."""
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS responses (endpoint TEXT, mediagate_id TEXT, response TEXT, fetched_at REAL, PRIMARY KEY (endpoint, mediagate_id))')
+            self.connection.commit()
+        return self.connection
+
+    def get_many(self, endpoint, mediagate_ids):
+        """Returns dict(mediagate_id : response) of the ids with a cached answer younger than ttl."""
+        if self.path is None or not mediagate_ids:
+            return {}
+        responses = {}
+        with self.lock:
+            connection = self.connect()
+            for start in range(0, len(mediagate_ids), 500):
+                chunk = mediagate_ids[start:start+500]
+                rows = connection.execute(
+                    f"SELECT mediagate_id, response FROM responses WHERE endpoint = ? AND fetched_at > ? AND mediagate_id IN ({','.join('?'*len(chunk))})",
+                    [endpoint, time.time()-self.ttl, *chunk])
+                responses.update({mediagate_id: json.loads(response) for mediagate_id, response in rows})
+        return responses
+
+    def get(self, endpoint, mediagate_id):
+        return self.get_many(endpoint, [mediagate_id]).get(mediagate_id)
+
+    def set_many(self, endpoint, responses):
+        if self.path is None or not responses:
+            return
+        now = time.time()
+        with self.lock:
+            connection = self.connect()
+            connection.executemany('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                                   [(endpoint, mediagate_id, json.dumps(response), now) for mediagate_id, response in responses.items()])
+            connection.commit()
+
+    def invalidate(self, endpoint=None, mediagate_ids=None):
+        """Removes cached answers: all of them, all of an endpoint ('details' or 'fileinfo'), or the given ids of an endpoint."""
+        if self.path is None:
+            return
+        with self.lock:
+            connection = self.connect()
+            if endpoint is None:
+                connection.execute('DELETE FROM responses')
+            elif mediagate_ids is None:
+                connection.execute('DELETE FROM responses WHERE endpoint = ?', (endpoint,))
+            else:
+                connection.executemany('DELETE FROM responses WHERE endpoint = ? AND mediagate_id = ?',
+                                       [(endpoint, str(mediagate_id)) for mediagate_id in mediagate_ids])
+            connection.commit()
+
+
+response_cache = ResponseCache(None if os.environ.get('MEDIAGATE_NO_CACHE') else cache_path)
+
+
+def reopen():
+    """New session and cache connection for a forked worker process, sockets and sqlite connections can't be shared with the parent."""
+    global session
+    session = create_session()
+    response_cache.reopen()
+
+
+def cacheable_details(mediagate_infos):
+    """The MediagateDetails answers worth caching: ids at the scan frontier are answered with empty ENC_EBREITE / ENC_EHOEHE
+    until the order is complete, these are asked again on the next run (like fileinfo answers without IMAGE_PATH)."""
+    return {mediagate_id: mediagate_info for mediagate_id, mediagate_info in mediagate_infos.items()
+            if mediagate_info.get('ENC_EBREITE') and mediagate_info.get('ENC_EHOEHE')}
+
+
+def read_mediagate_info(mediagate_id):
+    mediagate_info = response_cache.get('details', str(mediagate_id))
+    if mediagate_info is not None:
+        metrics.count('mediagate_details_cache_hit')
+        return mediagate_info
+    information = {'ids' : [str(mediagate_id)]}
+    with metrics.timed('http_mediagate_details'):
+        search_response = post(details_url, json = information, auth = auth)
+    metrics.add_bytes('http_mediagate_details', len(search_response.content))
+    mediagate_info = search_response.json()['Result'][0]
+    response_cache.set_many('details', cacheable_details({str(mediagate_id): mediagate_info}))
+    return mediagate_info
+
+
+def assign_details(mediagate_ids, results):
+    """Assigns the results of a MediagateDetails request to the requested ids: by their id field (see details_id_fields)
+    if every result has one, else by position if there is one result per id.
+
+    Returns:
+        dict(mediagate_id : mediagate_info) ; None if the results can't be assigned
+    """
+    for field in details_id_fields:
+        if results and all(isinstance(result, dict) and result.get(field) is not None for result in results):
+            requested = set(mediagate_ids)
+            return {str(result[field]): result for result in results if str(result[field]) in requested}
+    if len(results) == len(mediagate_ids):
+        return dict(zip(mediagate_ids, results))
+    return None
+
+
+def fetch_details(mediagate_ids):
+    """One MediagateDetails request for a list of ids (str). If the results can't be assigned to the ids (results
+    without id field are missing), the ids are split in halves and requested again; so only the part with the missing
+    results ends up being looked up id by id, not the whole list.
+
+    Returns:
+        dict(mediagate_id : mediagate_info), ids without a result are left out
+    """
+    information = {'ids' : mediagate_ids}
+    with metrics.timed('http_mediagate_details_batch'):
+        search_response = post(details_url, json = information, auth = auth)
+    metrics.add_bytes('http_mediagate_details_batch', len(search_response.content))
+    results = search_response.json()['Result']
+    if not results: # none of the ids has a result
+        return {}
+    mediagate_infos = assign_details(mediagate_ids, results)
+    if mediagate_infos is not None:
+        return mediagate_infos
+    if len(mediagate_ids) == 1:
+        return {mediagate_ids[0]: results[0]}
+
+    metrics.count('mediagate_details_split')
+    half = len(mediagate_ids)//2
+    mediagate_infos = fetch_details(mediagate_ids[:half])
+    mediagate_infos.update(fetch_details(mediagate_ids[half:]))
+    return mediagate_infos
+
+
+def read_mediagate_infos(mediagate_ids):
+    """Batched version of read_mediagate_info. The MediagateDetails endpoint takes a list of ids,
+    so a whole window of ids can be looked up with a single request (see fetch_details).
+
+    Args:
+        mediagate_ids : list of mediagate ids.
+
+    Returns:
+        dict(mediagate_id : mediagate_info). Ids without any result are left out. Cached ids are not requested again.
+    """
+    mediagate_ids = [str(mediagate_id) for mediagate_id in mediagate_ids]
+    mediagate_infos = response_cache.get_many('details', mediagate_ids)
+    missing_ids = [mediagate_id for mediagate_id in mediagate_ids if mediagate_id not in mediagate_infos]
+    metrics.count('mediagate_details_cache_hit', len(mediagate_infos))
+    if not missing_ids:
+        return mediagate_infos
+
+    fetched_infos = fetch_details(missing_ids)
+    response_cache.set_many('details', cacheable_details(fetched_infos))
+    mediagate_infos.update(fetched_infos)
+    return mediagate_infos
+
+
+def read_fileinfo(mediagate_id):
+    """Returns the clynx fileinfo json of the mediagate id (IMAGE_PATH, FILE_TYPE, ...)."""
+    fileinfo = response_cache.get('fileinfo', str(mediagate_id))
+    if fileinfo is not None:
+        metrics.count('fileinfo_cache_hit')
+        return fileinfo
+    with metrics.timed('http_fileinfo'):
+        response = get(fileinfo_url, params = {'id' : str(mediagate_id)})
+    metrics.add_bytes('http_fileinfo', len(response.content))
+    fileinfo = response.json()
+    if fileinfo.get('IMAGE_PATH'):
+        response_cache.set_many('fileinfo', {str(mediagate_id): fileinfo})
+    return fileinfo
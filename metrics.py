@@ -0,0 +1,155 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+
+
+script = os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'python' # running script, label of all metrics
+# prometheus textfile, one per script (e.g. in the directory of the node exporter textfile collector), so that
+# fetch_images, create_gaussian_dataset, update_dataset and prio_dataset don't overwrite each other's metrics
+metrics_path = os.environ.get('ROI_METRICS_FILE', os.path.join(os.environ.get('ROI_METRICS_DIR', '.'), f'roi_metrics_{script}.prom'))
+profile_path = os.environ.get('ROI_PROFILE') # cProfile stats of the main scripts are written here, if set
+prefix = 'roi_dataset'
+buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # seconds, upper bounds of the latency histograms
+
+
+lock = threading.Lock()
+counters = defaultdict(int) # event : count
+bytes_moved = defaultdict(int) # stage : bytes
+latencies = {} # stage : [bucket counts..., +Inf count, sum]
+
+
+def count(event, value=1):
+    """Counts hits, skips, errors, ... e.g. count('fetch_skipped'); value is an int, counters are exported exactly."""
+    with lock:
+        counters[event] += value
+
+
+def add_bytes(stage, size):
+    """Bytes read or written by a stage, e.g. add_bytes('copy_image', 1234)."""
+    with lock:
+        bytes_moved[stage] += size
+
+
+def observe(stage, seconds):
+    with lock:
+        histogram = latencies.get(stage)
+        if histogram is None:
+            histogram = latencies[stage] = [0]*(len(buckets)+1) + [0.0]
+        for i, bound in enumerate(buckets):
+            if seconds <= bound:
+                histogram[i] += 1
+                break
+        else:
+            histogram[len(buckets)] += 1
+        histogram[-1] += seconds
+
+
+@contextmanager
+def timed(stage):
+    """Adds the time of the block to the latency histogram of stage (also if it raises).
+
+    Example:
+        with metrics.timed('jpeg_decode'):
+            image = cv.imread(image_path)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter()-start)
+
+
+def take():
+    """Returns the metrics collected in this process and resets them, to send them from a worker process to the parent (see merge)."""
+    global counters, bytes_moved, latencies
+    with lock:
+        snapshot = {'counters': dict(counters), 'bytes': dict(bytes_moved), 'latencies': latencies}
+        counters = defaultdict(int)
+        bytes_moved = defaultdict(int)
+        latencies = {}
+    return snapshot
+
+
+def merge(snapshot):
+    """Adds the metrics of take() (e.g. of a worker process) to the metrics of this process."""
+    with lock:
+        for event, value in snapshot['counters'].items():
+            counters[event] += value
+        for stage, size in snapshot['bytes'].items():
+            bytes_moved[stage] += size
+        for stage, histogram in snapshot['latencies'].items():
+            if stage not in latencies:
+                latencies[stage] = list(histogram)
+            else:
+                latencies[stage] = [a+b for a, b in zip(latencies[stage], histogram)]
+
+
+def collected(function, *args):
+    """Runs function(*args) in a worker process and returns (result, take()), the parent merges the metrics.
+
+    Example:
+        future = executor.submit(metrics.collected, resize_and_gaussian_image, *args)
+        result, snapshot = future.result()
+        metrics.merge(snapshot)
+    """
+    take()
+    result = function(*args)
+    return result, take()
+
+
+def textfile():
+    """The metrics in the prometheus text exposition format."""
+    with lock:
+        lines = [f"# HELP {prefix}_stage_seconds Latency of the pipeline stages.", f"# TYPE {prefix}_stage_seconds histogram"]
+        for stage, histogram in sorted(latencies.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, histogram):
+                cumulative += bucket_count
+                lines.append(f'{prefix}_stage_seconds_bucket{{script="{script}",stage="{stage}",le="{bound}"}} {cumulative}')
+            cumulative += histogram[len(buckets)]
+            lines.append(f'{prefix}_stage_seconds_bucket{{script="{script}",stage="{stage}",le="+Inf"}} {cumulative}')
+            lines.append(f'{prefix}_stage_seconds_sum{{script="{script}",stage="{stage}"}} {histogram[-1]:.6f}')
+            lines.append(f'{prefix}_stage_seconds_count{{script="{script}",stage="{stage}"}} {cumulative}')
+
+        lines += [f"# HELP {prefix}_events_total Hits, skips and errors of the pipeline.", f"# TYPE {prefix}_events_total counter"]
+        lines += [f'{prefix}_events_total{{script="{script}",event="{event}"}} {value}' for event, value in sorted(counters.items())]
+
+        lines += [f"# HELP {prefix}_bytes_total Bytes read or written by the pipeline stages.", f"# TYPE {prefix}_bytes_total counter"]
+        lines += [f'{prefix}_bytes_total{{script="{script}",stage="{stage}"}} {size}' for stage, size in sorted(bytes_moved.items())]
+
+        lines += [f"# HELP {prefix}_last_write_timestamp_seconds Time of the last metrics export.",
+                  f"# TYPE {prefix}_last_write_timestamp_seconds gauge", f'{prefix}_last_write_timestamp_seconds{{script="{script}"}} {time.time():.0f}']
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path=None):
+    """Writes the metrics to path (default metrics_path) atomically, so that a scraper never reads half a file."""
+    path = path or metrics_path
+    if not path:
+        return
+    with open(path + '.tmp', 'w') as f:
+        f.write(textfile())
+    os.replace(path + '.tmp', path)
+
+
+@contextmanager
+def profiled(path=None):
+    """Runs the block under cProfile and writes the stats to path (default profile_path), if a path is set.
+    The stats can be read with pstats or snakeviz; the 30 most expensive functions are printed."""
+    path = path or profile_path
+    if not path:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(30)
@@ -0,0 +1,62 @@
+from concurrent.futures import ThreadPoolExecutor
+import xml.etree.ElementTree as ET
+
+
+pagebox_names = ('media', 'trim')
+
+
+def read_pageboxes(xml_file):
+    """Reads the media and trim box of the xml sidecar with iterparse. Parsing stops as soon as both boxes are read,
+    so the (sometimes large) separation metadata after them is never parsed, and no DOM of the whole file is built.
+
+    Like root.find("pageboxes").find("media").find(...), only the direct children of the first pageboxes element
+    of the root are read.
+
+    Args:
+        xml_file : path to the xml or a file opened in binary mode.
+
+    Returns:
+        dict(box name : dict(tag : text)), e.g. {'media': {'offsetx': '0', ...}, 'trim': {...}} ;
+        None if the xml has no pageboxes element
+    """
+    if isinstance(xml_file, str):
+        with open(xml_file, 'rb') as f:
+            return read_pageboxes(f)
+
+    pageboxes = None
+    tags = [] # tags from the root to the current element
+    for event, element in ET.iterparse(xml_file, events=('start', 'end')):
+        if event == 'start':
+            tags.append(element.tag)
+            if len(tags) == 2 and tags[1] == 'pageboxes' and pageboxes is None:
+                pageboxes = {}
+            continue
+
+        in_pageboxes = pageboxes is not None and len(tags) >= 2 and tags[1] == 'pageboxes'
+        if in_pageboxes and len(tags) == 4 and tags[2] in pagebox_names:
+            pageboxes.setdefault(tags[2], {}).setdefault(element.tag, element.text)
+        elif in_pageboxes and len(tags) == 3 and tags[2] in pagebox_names:
+            pageboxes.setdefault(tags[2], {})
+            if all(name in pageboxes for name in pagebox_names):
+                return pageboxes
+        elif in_pageboxes and len(tags) == 2:
+            return pageboxes # end of the pageboxes element
+        tags.pop()
+        element.clear()
+    return pageboxes
+
+
+def read_pageboxes_many(xml_paths, workers=8):
+    """read_pageboxes for many files, read concurrently (the sidecars are on the share).
+
+    Returns:
+        list of the results of read_pageboxes, in the order of xml_paths ; the exception for files that couldn't be read
+    """
+    def read(xml_path):
+        try:
+            return read_pageboxes(xml_path)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(read, xml_paths))
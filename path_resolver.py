@@ -0,0 +1,106 @@
+from collections import OrderedDict
+import json
+import metrics
+import os
+import threading
+
+
+path_cache_file = 'path_cache.jsonl'
+max_listed_directories = 4096 # directory listings kept in memory
+
+
+listings = OrderedDict()
+listings_lock = threading.Lock()
+
+
+def list_directory(directory):
+    """Lists the directory once with os.scandir (one round trip to the share) and keeps the names in memory.
+
+    Returns:
+        frozenset of the names in directory ; empty if it doesn't exist
+    """
+    with listings_lock:
+        if directory in listings:
+            listings.move_to_end(directory)
+            return listings[directory]
+    try:
+        with metrics.timed('share_listdir'), os.scandir(directory or '.') as entries:
+            names = frozenset(entry.name for entry in entries)
+    except (FileNotFoundError, NotADirectoryError):
+        names = frozenset()
+    with listings_lock:
+        listings[directory] = names
+        if len(listings) > max_listed_directories:
+            listings.popitem(last=False)
+    return names
+
+
+def exists(path):
+    """os.path.exists from the cached directory listing. The share may be case insensitive, so a name that only
+    matches with another case is checked with os.path.exists."""
+    directory, name = os.path.split(path)
+    names = list_directory(directory)
+    if name in names:
+        return True
+    if any(name.casefold() == listed.casefold() for listed in names):
+        return os.path.exists(path)
+    return False
+
+
+class PathCache:
+    """Persistent dict(key : resolved paths) in an append-only json lines file, shared by update_dataset.py
+    and prio_dataset.py. Safe to use from several threads.
+
+    Example:
+        path_cache = PathCache()
+        paths = path_cache.get(f"{mediagate_id}@repro")
+        if paths is None:
+            ...
+            path_cache.set(f"{mediagate_id}@repro", {'image_path': image_path, 'xml_path': xml_path})
+    """
+
+    def __init__(self, cache_path=path_cache_file):
+        self.cache_path = cache_path
+        self.paths = {}
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    key, value = json.loads(line)
+                    self.paths[key] = value
+        self.reopen()
+
+    def reopen(self):
+        """New lock and file handle, e.g. in a forked worker process. Lines are appended with O_APPEND and flushed one by one,
+        so several processes can add to the same cache file."""
+        self.lock = threading.Lock()
+        self.file = None
+
+    def get(self, key):
+        paths = self.paths.get(key)
+        metrics.count('path_cache_hit' if paths is not None else 'path_cache_miss')
+        return paths
+
+    def set(self, key, value):
+        with self.lock:
+            if self.paths.get(key) == value:
+                return
+            self.paths[key] = value
+            if self.file is None:
+                self.file = open(self.cache_path, 'a')
+            self.file.write(json.dumps([key, value]) + '\n')
+            self.file.flush()
+
+    def clear(self):
+        """Drops all cached paths, e.g. after files were moved on the share."""
+        with self.lock:
+            self.paths = {}
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if os.path.exists(self.cache_path):
+                os.remove(self.cache_path)
+
+
+path_cache = PathCache()
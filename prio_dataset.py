@@ -1,12 +1,18 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import csv
 import cv2 as cv
 import json
+import mediagate_client
+import metrics
+from mediagate_client import read_mediagate_info, read_fileinfo
 import os
 import numpy as np
+from pageboxes import read_pageboxes
 import pandas as pd
-import requests
+from path_resolver import exists, list_directory, path_cache
 from tqdm import tqdm
-import xml.etree.ElementTree as ET
 
 def csv_to_list(csv_path):
     with open(csv_path) as f:
@@ -16,16 +22,9 @@ def csv_to_list(csv_path):
     return list_data
 
 
-def read_mediagate_info(mediagate_id):
-    request_url = 'https://api.saueressig.de/MediagateAPI/MediagateDetails'
-    information = {'ids' : [mediagate_id]}
-    search_response = requests.post(request_url, json = information, auth = ('web2gravure', '5#dlKjgjAwh!!'))
-    return search_response.json()['Result'][0]
-
-
-
-def get_encoway_wh(mediagate_id):
-    mediagate_info = read_mediagate_info(str(mediagate_id))
+def get_encoway_wh(mediagate_id, mediagate_info=None):
+    if mediagate_info is None:
+        mediagate_info = read_mediagate_info(str(mediagate_id))
     if not mediagate_info['ENC_EBREITE'] or not mediagate_info['ENC_EHOEHE']:
         return 0,0
     enc_wh = np.array([float(mediagate_info['ENC_EBREITE']),float(mediagate_info['ENC_EHOEHE'])])
@@ -33,8 +32,13 @@ def get_encoway_wh(mediagate_id):
 
 
 def mediagate_2_image_path(mediagate_id, server_path):
-    response = requests.get(f"http://devwebvm087.saueressig.de/mediagate/public/clynx/fileinfo?id={mediagate_id}")
-    response_dict = response.json()
+    """Image path of the mediagate id on the share. Found paths are kept in the persistent path cache."""
+    key = f"{mediagate_id}@{server_path}"
+    paths = path_cache.get(key)
+    if paths is not None:
+        return paths['image_path']
+
+    response_dict = read_fileinfo(mediagate_id)
     if response_dict["FILE_TYPE"] == "daily":
         image_path = os.path.join(server_path, "customer_files", *response_dict["IMAGE_PATH"].split('/'))
     else:
@@ -43,18 +47,19 @@ def mediagate_2_image_path(mediagate_id, server_path):
     if image_path.endswith('.jpg'):
         image_path = image_path.replace('.jpg','.jpeg')
 
-    if not os.path.exists(image_path):
-        if os.path.exists(image_path.replace('.jpeg','_1.jpeg')):
+    if not exists(image_path):
+        if exists(image_path.replace('.jpeg','_1.jpeg')):
             image_path = image_path.replace('.jpeg','_1.jpeg')
-        elif os.path.exists(image_path.replace('.jpeg','_RAW.jpeg')):
+        elif exists(image_path.replace('.jpeg','_RAW.jpeg')):
             image_path = image_path.replace('.jpeg','_RAW.jpeg')
-        elif os.path.exists(image_path.replace('.jpeg','_RAW_1.jpeg')):
+        elif exists(image_path.replace('.jpeg','_RAW_1.jpeg')):
             image_path = image_path.replace('.jpeg','_RAW_1.jpeg')
 
         else:
             print(f"Couldn't find {image_path}")
-            image_path = None
+            return None
 
+    path_cache.set(key, {'image_path': image_path})
     return image_path  
 
 
@@ -69,7 +74,7 @@ def get_xml_path(image_path):
     else:
         xml_path = image_path.replace('.jpeg','.xml')
 
-    if not os.path.exists(xml_path):
+    if not exists(xml_path):
         print('--------------------------\n',xml_path, " doesn't exist \n")
         xml_path = None
 
@@ -85,23 +90,22 @@ def get_roi(xml_path):
     point_to_pixel = point_per_inch*pixel_per_inch
 
 
-    if not os.path.exists(xml_path):
+    if not exists(xml_path):
         return 0,0,0,0
-    tree = ET.parse(xml_path)
-    root = tree.getroot() 
-    pageboxes_element = root.find("pageboxes")
-    media_element = pageboxes_element.find("media")
-    trim_element = pageboxes_element.find("trim")
+    with metrics.timed('xml_parse'):
+        pageboxes = read_pageboxes(xml_path)
+    media_element = pageboxes["media"]
+    trim_element = pageboxes["trim"]
 
-    media_offsetx = float(media_element.find("offsetx").text)
-    media_offsety = float(media_element.find("offsety").text)
-    media_height = float(media_element.find("height").text)
+    media_offsetx = float(media_element["offsetx"])
+    media_offsety = float(media_element["offsety"])
+    media_height = float(media_element["height"])
 
-    trim_offsetx = float(trim_element.find("offsetx").text)
-    trim_offsety = float(trim_element.find("offsety").text)
+    trim_offsetx = float(trim_element["offsetx"])
+    trim_offsety = float(trim_element["offsety"])
 
-    roi_height = float(trim_element.find("height").text) * point_to_pixel
-    roi_width = float(trim_element.find("width").text) * point_to_pixel
+    roi_height = float(trim_element["height"]) * point_to_pixel
+    roi_width = float(trim_element["width"]) * point_to_pixel
 
     # our local (0,0) at bottom left corner, opencv hat (0,0) on top left corner. 
     roi_y_bottom_left = (trim_offsety -media_offsety)
@@ -130,61 +134,218 @@ def get_roi(xml_path):
 #         return False
 
 
-def get_daily2order_dict(excel_path):
-
-    df = pd.read_excel(excel_path)    
-    daily2order_dict =  {}
-
-    for i in range(len(df)):
-        daily_id = df.loc[i, "MEDAIGATE_DAILY"]
-        order_id = df.loc[i,"MEDIAGATE_ORDER"]
+def parse_daily2order(df):
+    """Vectorized parsing of the MEDAIGATE_DAILY / MEDIAGATE_ORDER columns of tagesdaten.xlsx. Rows with an integer
+    daily id and an integer order id or a string of comma separated order ids are used, like in the old row loop.
+    If a daily id appears in several rows, the last row is used.
 
-        if not type(daily_id) is int:
-            continue
-
-        if type(order_id) == int:
-            daily2order_dict.update({daily_id : [order_id]})
-        elif type(order_id) == str:
-            order_id = [int(i) for i in order_id.split(',')]
-            daily2order_dict.update({daily_id : order_id})
-        else:
-            continue
+    Returns:
+        dict(daily_id : [order_id, ...])
+    """
+    daily = df["MEDAIGATE_DAILY"]
+    order = df["MEDIAGATE_ORDER"]
 
+    if pd.api.types.is_integer_dtype(daily):
+        valid = pd.Series(True, index=df.index)
+    else:
+        valid = daily.map(type).isin([int, np.int64])
+    if pd.api.types.is_integer_dtype(order):
+        order_is_int = pd.Series(True, index=df.index)
+        order_is_str = ~order_is_int
+    else:
+        order_types = order.map(type)
+        order_is_int = order_types.isin([int, np.int64])
+        order_is_str = order_types == str
+
+    int_orders = order[valid & order_is_int].astype(np.int64)
+    str_orders = order[valid & order_is_str].astype(object)
+    if len(str_orders):
+        str_orders = str_orders.str.split(',').explode().str.strip().astype(np.int64)
+    orders = pd.concat([int_orders, str_orders.astype(np.int64)]).sort_index(kind='stable')
+
+    order_lists = orders.groupby(level=0, sort=True).agg(list) # one list per row
+    row_daily = daily[order_lists.index].astype(np.int64)
+    daily_ids = row_daily.drop_duplicates(keep='first').to_numpy() # dict order: first row of the daily id
+    last_rows = row_daily.drop_duplicates(keep='last') # mapping of the last row of the daily id, like dict.update
+    last_row = pd.Series(last_rows.index, index=last_rows.to_numpy())
+    return dict(zip(daily_ids.tolist(), order_lists[last_row[daily_ids].to_numpy()].tolist()))
+
+
+def save_daily2order(daily2order, cache_path, source_stat=None):
+    """Writes the mapping as flat numpy arrays (daily ids, offsets into the concatenated order ids) to cache_path (.npz)."""
+    daily_ids = np.array(list(daily2order), dtype=np.int64)
+    lengths = np.array([len(orders) for orders in daily2order.values()], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    order_ids = np.array([order_id for orders in daily2order.values() for order_id in orders], dtype=np.int64)
+    source = np.array([source_stat.st_size, source_stat.st_mtime_ns] if source_stat is not None else [-1, -1], dtype=np.int64)
+    with open(cache_path + '.tmp', 'wb') as f:
+        np.savez(f, daily_ids=daily_ids, offsets=offsets, order_ids=order_ids, source=source)
+    os.replace(cache_path + '.tmp', cache_path)
+
+
+def load_daily2order(cache_path, source_stat=None):
+    """Reads the mapping written by save_daily2order.
+
+    Returns:
+        dict(daily_id : [order_id, ...]) ; None if there is no cache or it was made from another version of the excel
+    """
+    if not os.path.exists(cache_path):
+        return None
+    with np.load(cache_path) as cache:
+        if source_stat is not None and cache["source"].tolist() != [source_stat.st_size, source_stat.st_mtime_ns]:
+            return None
+        daily_ids = cache["daily_ids"].tolist()
+        offsets = cache["offsets"].tolist()
+        order_ids = cache["order_ids"].tolist()
+    return {daily_id: order_ids[offsets[i]:offsets[i+1]] for i, daily_id in enumerate(daily_ids)}
+
+
+def get_daily2order_dict(excel_path, cache_path=None):
+    """Reads the daily -> order mapping from tagesdaten.xlsx.
+
+    Args:
+        excel_path : tagesdaten.xlsx
+        cache_path : .npz file with the parsed mapping; it's used as long as the size and mtime of the excel are unchanged.
+
+    Returns:
+        dict(daily_id : [order_id, ...])
+    """
+    source_stat = os.stat(excel_path) if cache_path is not None else None
+    if cache_path is not None:
+        daily2order_dict = load_daily2order(cache_path, source_stat)
+        if daily2order_dict is not None:
+            return daily2order_dict
+
+    df = pd.read_excel(excel_path, usecols=["MEDAIGATE_DAILY", "MEDIAGATE_ORDER"])
+    daily2order_dict = parse_daily2order(df)
+
+    if cache_path is not None:
+        save_daily2order(daily2order_dict, cache_path, source_stat)
     return daily2order_dict
 
 
-def get_best_daily2order(daily2order, clip_data_path = "M:\\dockerdata\\clipData\\image_embeddings\\"):
-    
-    filtered_daily2order = {}
-
-    for daily_id, order_ids in daily2order.items():
-        print(f"Daily ID : {daily_id}\n\n")
-        daily_npy = clip_data_path+str(daily_id)+".npy"
-
-        if not os.path.exists(daily_npy):
-            print(f"No Embedding for {daily_id}")
-            continue
+def embedding_mtimes(directory, mediagate_ids):
+    """dict(mediagate_id : mtime) of the .npy embeddings of mediagate_ids in directory. The directory is listed once
+    (path_resolver.list_directory) to see which exist, only these are stat'ed; the other files of the directory
+    aren't touched."""
+    names = list_directory(directory)
+    mtimes = {}
+    for mediagate_id in mediagate_ids:
+        if mediagate_id+".npy" in names:
+            with metrics.timed('share_stat'):
+                mtimes[mediagate_id] = os.stat(os.path.join(directory, mediagate_id+".npy")).st_mtime
+    return mtimes
+
+
+class EmbeddingIndex:
+    """All needed CLIP embeddings in one normalized float32 matrix (one row per mediagate id).
+    The matrix is kept in index_path.npy / index_path_ids.json and memory mapped on the next run,
+    only embeddings that are not in it yet are loaded from the single .npy files. The ids file also keeps the
+    embedding directory and the mtime of every embedding: rows of changed embeddings are loaded again, an index
+    of another directory is built anew.
+
+    Args:
+        mediagate_ids  : ids, whose embeddings are needed.
+        clip_data_path : directory with {mediagate_id}.npy embeddings.
+        index_path     : path of the index files, without extension; None keeps the index in memory only.
+    """
+
+    def __init__(self, mediagate_ids, clip_data_path, index_path="clip_embedding_index"):
+        source = os.path.normpath(os.path.abspath(clip_data_path))
+        mediagate_ids = list(dict.fromkeys(str(mediagate_id) for mediagate_id in mediagate_ids))
+
+        ids, mtimes = [], []
+        matrix = None
+        if index_path is not None and os.path.exists(index_path+"_ids.json") and os.path.exists(index_path+".npy"):
+            with open(index_path+"_ids.json") as f:
+                stored = json.load(f)
+            if isinstance(stored, dict) and stored['source'] == source:
+                matrix = np.load(index_path+".npy", mmap_mode='r')
+                if len(matrix) == len(stored['ids']): # else interrupted between writing the two files
+                    ids, mtimes = stored['ids'], stored['mtimes']
+                else:
+                    matrix = None
+
+        available = embedding_mtimes(source, dict.fromkeys(mediagate_ids + ids))
+        keep = [row for row, (mediagate_id, mtime) in enumerate(zip(ids, mtimes)) if available.get(mediagate_id) == mtime]
+        changed = len(keep) != len(ids)
+        if changed:
+            matrix = matrix[keep] if keep else None
+            ids = [ids[row] for row in keep]
+            mtimes = [mtimes[row] for row in keep]
+
+        known_ids = set(ids)
+        new_ids, new_mtimes, new_rows = [], [], []
+        for mediagate_id in mediagate_ids:
+            if mediagate_id in known_ids:
+                continue
+            if mediagate_id not in available:
+                print(f"No Embedding for {mediagate_id}")
+                continue
+            embedding = np.load(os.path.join(source, mediagate_id+".npy")).astype(np.float32).ravel()
+            new_ids.append(mediagate_id)
+            new_mtimes.append(available[mediagate_id])
+            new_rows.append(embedding/np.linalg.norm(embedding))
+
+        if new_rows:
+            new_matrix = np.stack(new_rows)
+            matrix = new_matrix if matrix is None else np.concatenate([matrix, new_matrix])
+            ids = ids + new_ids
+            mtimes = mtimes + new_mtimes
+        if (new_rows or changed) and index_path is not None and matrix is not None:
+            with open(index_path+".npy.tmp", 'wb') as f:
+                np.save(f, matrix)
+            os.replace(index_path+".npy.tmp", index_path+".npy")
+            with open(index_path+"_ids.json.tmp", 'w') as f:
+                json.dump({'source': source, 'ids': ids, 'mtimes': mtimes}, f)
+            os.replace(index_path+"_ids.json.tmp", index_path+"_ids.json")
+            matrix = np.load(index_path+".npy", mmap_mode='r')
+
+        self.matrix = matrix
+        self.row = {mediagate_id: row for row, mediagate_id in enumerate(ids)}
+
+    def __contains__(self, mediagate_id):
+        return str(mediagate_id) in self.row
+
+    def scores(self, pairs, chunk_size=65536):
+        """Cosine similarity of each (id_1, id_2) pair, both ids have to be in the index. Computed as batched dot products of the rows."""
+        rows_1 = np.array([self.row[str(id_1)] for id_1, _ in pairs], dtype=np.int64)
+        rows_2 = np.array([self.row[str(id_2)] for _, id_2 in pairs], dtype=np.int64)
+        scores = np.empty(len(pairs), dtype=np.float32)
+        for start in range(0, len(pairs), chunk_size):
+            end = start+chunk_size
+            scores[start:end] = np.einsum('ij,ij->i', self.matrix[rows_1[start:end]], self.matrix[rows_2[start:end]])
+        return scores
+
+
+def get_best_daily2order(daily2order, clip_data_path = "M:\\dockerdata\\clipData\\image_embeddings\\", threshold=0.9, index_path="clip_embedding_index"):
+    """For every daily the order with the most similar CLIP embedding, if the cosine similarity is above threshold.
+
+    Args:
+        daily2order    : dict(daily_id : [order_ids]).
+        clip_data_path : directory with {mediagate_id}.npy embeddings.
+        threshold      : minimum cosine similarity.
+        index_path     : see EmbeddingIndex.
+
+    Returns:
+        dict(daily_id : order_id)
+    """
+    index = EmbeddingIndex([mediagate_id for daily_id, order_ids in daily2order.items() for mediagate_id in [daily_id, *order_ids]],
+                           clip_data_path, index_path)
+
+    pairs = [(daily_id, order_id) for daily_id, order_ids in daily2order.items() if daily_id in index
+             for order_id in order_ids if order_id in index]
+    if not pairs:
+        return {}
+    scores = index.scores(pairs)
 
-        daily_emb = np.load(daily_npy)
-        daily_emb_norm = daily_emb/np.linalg.norm(daily_emb)
-        best_match=0.9
+    filtered_daily2order = {}
+    best_match = {}
+    for (daily_id, order_id), matching in zip(pairs, scores):
+        if matching>best_match.get(daily_id, threshold):
+            best_match[daily_id] = matching
+            filtered_daily2order.update({daily_id:order_id})
 
-        for order_id in order_ids:
-            order_npy = clip_data_path+str(order_id)+".npy"
-            if not os.path.exists(order_npy):
-                print(f"No Embedding for {order_id}")
-                continue
-            order_emb = np.load(order_npy)
-            order_emb_norm = order_emb/np.linalg.norm(order_emb)
-            matching = order_emb_norm @ daily_emb_norm.T
-            print(f"""
-            Order ID : {order_id} 
-            Match : {matching} \n \n""")
-
-            if matching>best_match:
-                best_match = matching
-                filtered_daily2order.update({daily_id:order_id})
-    
     return filtered_daily2order
 
 
@@ -205,22 +366,331 @@ def get_cropped_order_image(image, roi):
 #         return maxLoc
 
 
+def match_template(image, template):
+    """Brute force cv.TM_CCOEFF_NORMED matching at full resolution. Returns (maxVal, maxLoc)."""
+    result = cv.matchTemplate(image, template, cv.TM_CCOEFF_NORMED)
+    minVal, maxVal, minLoc, maxLoc = cv.minMaxLoc(result)
+    return maxVal, maxLoc
+
+
+def match_template_pyramid(image, template, max_level=4, min_template_size=32, candidates=5, final_candidates=3, min_score=0.95):
+    """Coarse to fine version of match_template. The image and the template are matched at 1/2**level of their size,
+    (level as high as possible, while the template keeps min_template_size pixels). The best candidates of the coarse
+    match are refined level by level, each time in a small window around the position of the level above, and the
+    final_candidates best of them at full resolution. The coarse search can miss the true position (and still find
+    a fair score elsewhere), so if the best full resolution score is below min_score, the brute force match_template
+    is used instead.
+
+    Args:
+        image             : image to search in.
+        template          : image to search for.
+        max_level         : maximum pyramid level, i.e. downscaling by 2**max_level.
+        min_template_size : minimum size of the downscaled template in pixels.
+        candidates        : number of coarse candidates, that are refined.
+        final_candidates  : number of candidates refined at full resolution (the best of the level above); None refines all of them.
+        min_score         : full resolution score, below which match_template is used; None never falls back.
+
+    Returns:
+        (maxVal, maxLoc) like match_template ; the score is computed at full resolution
+    """
+    level = 0
+    while level<max_level and min(template.shape[:2])>>(level+1) >= min_template_size:
+        level += 1
+    if level==0:
+        return match_template(image, template)
+
+    pyramid = [(image, template)]
+    for _ in range(level):
+        previous_image, previous_template = pyramid[-1]
+        pyramid.append((cv.resize(previous_image, (previous_image.shape[1]//2, previous_image.shape[0]//2), interpolation=cv.INTER_AREA),
+                        cv.resize(previous_template, (previous_template.shape[1]//2, previous_template.shape[0]//2), interpolation=cv.INTER_AREA)))
+
+    coarse_image, coarse_template = pyramid[level]
+    coarse = cv.matchTemplate(coarse_image, coarse_template, cv.TM_CCOEFF_NORMED)
+    suppression = max(1, min(coarse_template.shape[:2])//2)
+    matches = []
+    for _ in range(candidates):
+        _, coarse_val, _, (cx, cy) = cv.minMaxLoc(coarse)
+        if coarse_val<=-1:
+            break
+        coarse[max(cy-suppression,0):cy+suppression+1, max(cx-suppression,0):cx+suppression+1] = -1
+        matches.append((coarse_val, (cx, cy)))
+
+    for refine_level in range(level-1, -1, -1):
+        level_image, level_template = pyramid[refine_level]
+        height, width = level_template.shape[:2]
+        if refine_level==0 and final_candidates is not None:
+            matches = matches[:final_candidates]
+        refined = []
+        for _, (cx, cy) in matches:
+            # one pixel of the level above is two pixels here, +-1 pixel for the rounding of the downscaling
+            x0 = max(2*cx-3, 0)
+            y0 = max(2*cy-3, 0)
+            x1 = min(2*cx+3+width, level_image.shape[1])
+            y1 = min(2*cy+3+height, level_image.shape[0])
+            val, (x, y) = match_template(level_image[y0:y1, x0:x1], level_template)
+            refined.append((val, (x0+x, y0+y)))
+        matches = sorted(refined, key=lambda match: match[0], reverse=True)
+
+    if min_score is not None and (not matches or matches[0][0]<min_score):
+        metrics.count('template_match_fallback')
+        return match_template(image, template)
+    return matches[0]
+
+
+def check_match_template_pyramid(image, template, **pyramid_args):
+    """Correctness check of match_template_pyramid against the brute force match_template.
+
+    Returns:
+        dict(brute_force=(maxVal, maxLoc), pyramid=(maxVal, maxLoc), same_location=bool, score_difference=float,
+             agree=bool) ; agree is also True for a tie (another location with the same score, e.g. a repeated pattern)
+    """
+    brute_force = match_template(image, template)
+    pyramid = match_template_pyramid(image, template, **pyramid_args)
+    same_location = tuple(brute_force[1])==tuple(pyramid[1])
+    return {'brute_force': brute_force, 'pyramid': pyramid,
+            'same_location': same_location,
+            'score_difference': brute_force[0]-pyramid[0],
+            'agree': same_location or brute_force[0]-pyramid[0] < 1e-3}
+
+
+
+def init_pair_worker():
+    """Initializer of the process_pairs worker processes."""
+    cv.setNumThreads(1)
+    mediagate_client.reopen()
+    path_cache.reopen()
+
+
+pair_errors = ('no_xml', 'empty_roi', 'template_too_big') # failures of a pair, that won't go away on a rerun
+
+
+def process_pair(daily_id, order_id, server_path):
+    """Finds the roi of the order image in the daily image: resolves both image paths, crops the roi (from the xml)
+    out of the order image and searches it in the daily image with match_template_pyramid.
+
+    Returns:
+        dict with the columns of dataset_neu.xlsx ; empty dict if an image wasn't found ; if the pair can't be matched
+        (see pair_errors) the row so far and 'error' ; None on any other error (network, share, unreadable image),
+        these pairs are tried again on the next run
+    """
+    row = None
+    try:
+        with metrics.timed('prio_image_path'):
+            order_image_path = mediagate_2_image_path(order_id, server_path)
+        if order_image_path is None:
+            metrics.count('prio_missing_image')
+            return {}
+        with metrics.timed('jpeg_decode'):
+            order_image = cv.imread(order_image_path, cv.IMREAD_COLOR)
+        if order_image is None:
+            raise OSError(f"can't read {order_image_path}")
+        xml_path = get_xml_path(order_image_path)
+        if xml_path is None:
+            metrics.count('prio_pair_error')
+            return {'order_filename': order_image_path, 'error': 'no_xml'}
+        order_roi = get_roi(xml_path)
+
+        cropped_image = get_cropped_order_image(order_image, order_roi)
+        if cropped_image is None or cropped_image.size == 0:
+            metrics.count('prio_pair_error')
+            return {'order_filename': order_image_path, 'order_xywh': order_roi, 'error': 'empty_roi'}
+        height, width, c = cropped_image.shape
+
+        with metrics.timed('prio_image_path'):
+            daily_image_path = mediagate_2_image_path(daily_id, server_path)
+        if daily_image_path is None:
+            metrics.count('prio_missing_image')
+            return {}
+        with metrics.timed('jpeg_decode'):
+            daily_image = cv.imread(daily_image_path, cv.IMREAD_COLOR)
+        if daily_image is None:
+            raise OSError(f"can't read {daily_image_path}")
+        dh,dw,dc = daily_image.shape
+
+        row = {"order_id": order_id,
+               "order_filename": order_image_path,
+               "daily_id": daily_id,
+               "daily_filename": daily_image_path,
+               "order_xywh": order_roi,
+               "order_image.shape": order_image.shape,
+               "daily_image.shape": daily_image.shape}
+
+        if height>dh or width>dw:
+            metrics.count('prio_pair_error')
+            row['error'] = 'template_too_big'
+            return row
+
+        with metrics.timed('template_match'):
+            maxVal, maxLoc = match_template_pyramid(daily_image, cropped_image)
+        print(maxVal)
+        if maxVal>.5:
+            dx,dy = maxLoc
+            row['daily_xywh'] = [dx,dy,width,height]
+            metrics.count('prio_matched')
+        else:
+            metrics.count('prio_unmatched')
+
+    except Exception as e:
+        print("Oops!", e.__class__, "occurred.")
+        metrics.count('prio_error')
+        return None
+
+    return row
+
+
+def default_pair_workers(worker_memory=2*1024**3):
+    """Number of process_pairs workers for the memory available now (MemAvailable of /proc/meminfo): each worker
+    holds a daily and an order image with their pyramids, about worker_memory bytes. At most one per cpu; 4 if the
+    available memory is unknown.
+    """
+    cpus = os.cpu_count() or 1
+    try:
+        with open('/proc/meminfo') as f:
+            available = next(int(line.split()[1])*1024 for line in f if line.startswith('MemAvailable:'))
+    except (OSError, StopIteration, ValueError):
+        return min(4, cpus)
+    return max(1, min(cpus, available//worker_memory))
+
+
+def process_pairs(daily2order, server_path, workers=1):
+    """process_pair for every (daily_id, order_id) in a pool of workers processes. Up to 2*workers pairs are in work,
+    so while a worker is matching, the other workers already load (path lookup, decode) the next images.
+
+    If a worker process dies (e.g. killed for lack of memory), the pool is broken: the pairs in work are submitted
+    again to a new pool with half the workers. A pair that breaks a pool of one worker is left out.
+
+    Yields:
+        (daily_id, order_id, row of process_pair) in the order of daily2order ; pairs with an error, that may go away
+        on a rerun (process_pair returns None), are left out
+    """
+    if workers<=1:
+        for daily_id, order_id in daily2order.items():
+            row = process_pair(daily_id, order_id, server_path)
+            if row is not None:
+                yield daily_id, order_id, row
+        return
+
+    todo = deque(daily2order.items())
+    while todo:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=init_pair_worker)
+        pending = deque()
+        try:
+            while todo or pending:
+                while todo and len(pending)<2*workers:
+                    daily_id, order_id = todo[0]
+                    pending.append((daily_id, order_id, executor.submit(metrics.collected, process_pair, daily_id, order_id, server_path)))
+                    todo.popleft()
+                daily_id, order_id, future = pending[0]
+                row, worker_metrics = future.result()
+                pending.popleft()
+                metrics.merge(worker_metrics)
+                if row is not None:
+                    yield daily_id, order_id, row
+        except BrokenProcessPool as e:
+            print("Error!", e.__class__, "occurred with", workers, "workers.")
+            metrics.count('prio_pool_broken')
+            if workers == 1:
+                pending.popleft() # the pair the only worker died on
+                metrics.count('prio_error')
+            todo.extendleft(reversed([(daily_id, order_id) for daily_id, order_id, _ in pending]))
+            workers = max(1, workers//2)
+        finally:
+            executor.shutdown()
+
+
+class PairResults:
+    """Append-only csv of the processed daily/order pairs, one row per pair as it is finished. Replaces filling
+    a DataFrame cell by cell and rewriting dataset_neu.xlsx every 10 rows; the xlsx is written once with export_excel.
+
+    Pairs without images are written with their ids only, so they are skipped on the next run as well. Pairs that
+    can't be matched are written with the reason in the column error (see pair_errors); they are skipped as well,
+    unless retry_errors is set. Other errors (network, share) aren't written, these pairs are tried again. A retried
+    pair gets a new row, the last one counts.
+
+    Example:
+        with PairResults() as results:
+            todo = {daily_id: order_id for daily_id, order_id in daily2order.items() if (daily_id, order_id) not in results}
+            for daily_id, order_id, row in process_pairs(todo, server_path):
+                results.append(daily_id, order_id, row)
+            results.export_excel("dataset_neu.xlsx")
+    """
+
+    columns = ["order_id", "order_filename", "daily_id", "daily_filename", "order_xywh", "daily_xywh","order_image.shape","daily_image.shape","error"]
+
+    def __init__(self, path="dataset_neu.csv", retry_errors=False):
+        self.path = path
+        self.done = set()
+
+        new_file = not os.path.exists(path) or os.path.getsize(path)==0
+        if not new_file:
+            with open(path, 'rb+') as f:
+                content = f.read()
+                if not content.endswith(b'\n'):
+                    f.truncate(content.rfind(b'\n')+1) # incomplete last row of an interrupted write
+            with open(path, newline='') as f:
+                reader = csv.DictReader(f)
+                for row in reader:
+                    pair = (row["daily_id"], row["order_id"])
+                    if row.get("error") and (retry_errors or row["error"] not in pair_errors):
+                        self.done.discard(pair)
+                    else:
+                        self.done.add(pair)
+            if reader.fieldnames != self.columns: # csv of an older version, without the error column
+                pd.read_csv(path, dtype=str).reindex(columns=self.columns).to_csv(path + '.tmp', index=False)
+                os.replace(path + '.tmp', path)
+
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=self.columns)
+        if new_file:
+            self.writer.writeheader()
+            self.file.flush()
+
+    def __contains__(self, pair):
+        daily_id, order_id = pair
+        return (str(daily_id), str(order_id)) in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def append(self, daily_id, order_id, row):
+        row = dict(row, daily_id=daily_id, order_id=order_id)
+        self.writer.writerow({column: value if isinstance(value, str) else str(value) for column, value in row.items()})
+        self.file.flush()
+        self.done.add((str(daily_id), str(order_id)))
+
+    def export_excel(self, excel_path="dataset_neu.xlsx"):
+        """Writes the pairs with images and without error to excel_path, with the columns (and row index starting at 2) of the old dataset_neu.xlsx."""
+        self.file.flush()
+        df = pd.read_csv(self.path)
+        df = df.drop_duplicates(["daily_id", "order_id"], keep='last') # a retried pair counts with its last row
+        df = df[df["order_filename"].notna() & df["error"].isna()]
+        df = df.drop(columns="error")
+        df.index = range(2, len(df)+2)
+        df.to_excel(excel_path)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
 
 if __name__ == "__main__":
     prio_1_csv = "/roi/prio_1.csv" # daily data
     daily2order_xlsx = "/roi/tagesdaten.xlsx"
     clip_data_path = "/image_embeddings/"
     server_path = "/Netz/devarcsv041/orderdata"
+    pair_workers = default_pair_workers() # daily/order pairs processed in parallel, as many as the memory allows
+    results_csv = "dataset_neu.csv" # finished pairs, a rerun continues after these
+    retry_errors = False # process the pairs again that had an error in an earlier run
 
-    prio_1_list = [id for ids in csv_to_list(prio_1_csv) for id in ids]
+    prio_1_list = {id for ids in csv_to_list(prio_1_csv) for id in ids}
     
-    if os.path.exists("daily2order_prio1_all.json"):
-        with open("daily2order_prio1_all.json") as f:
-            daily2order_all = json.load(f)
-    else:
-        daily2order_all =  get_daily2order_dict(daily2order_xlsx)
-        with open("daily2order_prio1_all.json",'w') as f:
-            json.dump(daily2order_all, f)
+    daily2order_all = get_daily2order_dict(daily2order_xlsx, "daily2order_all.npz")
 
     daily2order_p1_all = {daily:orders for daily, orders in daily2order_all.items() if str(daily) in prio_1_list}
 
@@ -234,55 +704,19 @@ if __name__ == "__main__":
             json.dump(daily2order_p1, f)
 
 
-    df = pd.DataFrame(columns=["order_id", "order_filename", "daily_id", "daily_filename", "order_xywh", "daily_xywh","order_image.shape","daily_image.shape"])
-    idx = 1
+    with PairResults(results_csv, retry_errors) as results, metrics.profiled():
+        todo = {daily_id: order_id for daily_id, order_id in daily2order_p1.items() if (daily_id, order_id) not in results}
+        print(len(results), "pairs already processed,", len(todo), "to do.")
 
+        for daily_id, order_id, row in tqdm(process_pairs(todo, server_path, pair_workers), total=len(todo)):
+            results.append(daily_id, order_id, row)
+            if len(results)%100==0:
+                metrics.write_textfile()
 
-    for daily_id, order_id in tqdm(daily2order_p1.items()):
-        try:
-            order_image_path = mediagate_2_image_path(order_id, server_path)
-            if order_image_path is None:
-                continue
-            order_image = cv.imread(order_image_path, cv.IMREAD_COLOR)
-            xml_path = get_xml_path(order_image_path)
-            order_roi = get_roi(xml_path)
-
-            cropped_image = get_cropped_order_image(order_image, order_roi)
-            height, width, c = cropped_image.shape
+        with metrics.timed('excel_export'):
+            results.export_excel("dataset_neu.xlsx")
+        metrics.write_textfile()
 
-            daily_image_path = mediagate_2_image_path(daily_id, server_path)
-            if daily_image_path is None:
-                continue
-            daily_image = cv.imread(daily_image_path, cv.IMREAD_COLOR)
-            dh,dw,dc = daily_image.shape
-
-            # x,y = get_daily_xy(daily_image, cropped_image)
-
-            idx+=1
-
-            df.at[idx,"order_id"] = order_id
-            df.at[idx,"order_filename"] = order_image_path
-            df.at[idx,"daily_id"] = daily_id
-            df.at[idx,"daily_filename"] = daily_image_path
-            df.at[idx,"order_xywh"] = order_roi
-            df.at[idx,"order_image.shape"] = order_image.shape
-            df.at[idx,"daily_image.shape"] = daily_image.shape
-
-            
-
-            result = cv.matchTemplate(daily_image, cropped_image, cv.TM_CCOEFF_NORMED)
-            minVal, maxVal, minLoc, maxLoc = cv.minMaxLoc(result)
-            print(maxVal)
-            if maxVal>.5:
-                dx,dy = maxLoc
-                df.at[idx,'daily_xywh'] = [dx,dy,width,height]
-        
-        except Exception as e:
-            print("Oops!", e.__class__, "occurred.")
-
-        if idx%10==0:
-            df.to_excel("dataset_neu.xlsx")
-    
     print('Finished. Press any key to continue...')
     x = input()
 
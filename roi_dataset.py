@@ -0,0 +1,224 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import cv2 as cv
+from create_gaussian_dataset import read_jpeg_size, reduced_imread_flag, render_gaussian_target
+import json
+import numpy as np
+import os
+
+
+class RoiDataset:
+    """Reads the dataset written by resized_and_gaussian_images. The gaussian targets are not read from the
+    gaussian directories, they are rendered from roi_in_percent at read time, in any resolution.
+
+    Example:
+        dataset = RoiDataset("/roi/latest_roi_repro_2048", dimension=1024)
+        image, roi_in_percent, target = dataset[0]
+    """
+
+    def __init__(self, image_dir_dim, dimension=2048, roi_percent_path="images_roi_percent_latest.json"):
+        """
+        Args:
+            image_dir_dim    : directory with the resized images.
+            dimension        : size of the returned images and targets; the images are resized, if they have another size.
+            roi_percent_path : json with dict(local_image_path : roi_in_percent).
+        """
+        self.image_dir_dim = image_dir_dim
+        self.dimension = dimension
+
+        with open(roi_percent_path) as f:
+            images_roi_percentage_dict = json.load(f)
+        self.samples = [(os.path.join(image_dir_dim, os.path.basename(image_path)), roi_in_percent)
+                        for image_path, roi_in_percent in images_roi_percentage_dict.items()]
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        """Returns (image, roi_in_percent, target) ; image is (dimension x dimension x 3), target (dimension x dimension), both uint8."""
+        image_path, roi_in_percent = self.samples[index]
+        return self.read_image(image_path), roi_in_percent, self.target(index)
+
+    def roi_in_percent(self, index):
+        return self.samples[index][1]
+
+    def image(self, index, dimension=None, reduced_decode=False):
+        return self.read_image(self.samples[index][0], dimension, reduced_decode)
+
+    def read_image(self, image_path, dimension=None, reduced_decode=False):
+        """Reads the image in dimension x dimension (default: self.dimension). With reduced_decode, a jpeg at least twice
+        as big as dimension is decoded at a reduced size (see create_gaussian_dataset.reduced_imread_flag)."""
+        dimension = dimension or self.dimension
+        flag = cv.IMREAD_COLOR
+        if reduced_decode:
+            image_size = read_jpeg_size(image_path)
+            if image_size is not None:
+                flag = reduced_imread_flag(image_size, dimension)
+        image = cv.imread(image_path, flag)
+        if image is None:
+            raise FileNotFoundError(image_path)
+        if image.shape[:2] != (dimension, dimension):
+            image = cv.resize(image, (dimension, dimension), interpolation=cv.INTER_AREA)
+        return image
+
+    def target(self, index, dimension=None):
+        """Gaussian target of the sample in dimension x dimension (default: self.dimension), rendered from its roi;
+        same as the images in the gaussian directories (without jpeg compression)."""
+        return render_gaussian_target(self.samples[index][1], dimension or self.dimension)
+
+
+class ShardDataset:
+    """Reads the shards written by create_gaussian_dataset.write_shards. The shard files are memory mapped,
+    a sample is read by its offset in the index: npy shards return views into the map (no decoding, no copy),
+    tar shards decode the jpeg bytes straight from the map.
+
+    Example:
+        dataset = ShardDataset("/roi/latest_roi_repro_shards_2048")
+        image, roi_in_percent, target = dataset[0]
+    """
+
+    def __init__(self, shard_dir):
+        """
+        Args:
+            shard_dir : directory with index.json and the shards.
+        """
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, 'index.json')) as f:
+            index = json.load(f)
+        self.format = index['format']
+        self.dimension = index['dimension']
+        self.samples = index['samples']
+        self.maps = {}
+
+    def __len__(self):
+        return len(self.samples)
+
+    def shard(self, name):
+        """Memory map of a shard file, opened on first use (so each worker process opens its own)."""
+        if name not in self.maps:
+            path = os.path.join(self.shard_dir, name)
+            if self.format == 'npy':
+                self.maps[name] = np.load(path, mmap_mode='r')
+            else:
+                self.maps[name] = np.memmap(path, dtype=np.uint8, mode='r')
+        return self.maps[name]
+
+    def roi_in_percent(self, index):
+        return self.samples[index]['roi_in_percent']
+
+    def image(self, index, dimension=None, reduced_decode=False):
+        """Image of the sample in dimension x dimension (default: the dimension of the shards), see RoiDataset.read_image."""
+        dimension = dimension or self.dimension
+        sample = self.samples[index]
+        if self.format == 'npy':
+            image = self.shard(f"images-{sample['shard']}.npy")[sample['row']]
+        else:
+            flag = reduced_imread_flag((self.dimension, self.dimension), dimension) if reduced_decode else cv.IMREAD_COLOR
+            offset, size = sample['image']
+            image = cv.imdecode(self.shard(f"images-{sample['shard']}.tar")[offset:offset+size], flag)
+            if image is None:
+                raise ValueError(f"can not decode {sample['name']} in shard {sample['shard']}")
+        if image.shape[:2] != (dimension, dimension):
+            image = cv.resize(image, (dimension, dimension), interpolation=cv.INTER_AREA)
+        return image
+
+    def target(self, index, dimension=None):
+        """Gaussian target of the sample in dimension x dimension (default: the dimension of the shards). The stored
+        target (npy shards, tar shards with gaussian images) is returned if it has this size, else it is rendered
+        from the roi in percent."""
+        dimension = dimension or self.dimension
+        sample = self.samples[index]
+        if dimension != self.dimension:
+            return render_gaussian_target(sample['roi_in_percent'], dimension)
+        if self.format == 'npy':
+            return self.shard(f"targets-{sample['shard']}.npy")[sample['row']]
+        if sample['target'] is None:
+            return render_gaussian_target(sample['roi_in_percent'], dimension)
+        offset, size = sample['target']
+        target = cv.imdecode(self.shard(f"images-{sample['shard']}.tar")[offset:offset+size], cv.IMREAD_GRAYSCALE)
+        if target is None:
+            raise ValueError(f"can not decode the target of {sample['name']} in shard {sample['shard']}")
+        return target
+
+    def __getitem__(self, index):
+        """Returns (image, roi_in_percent, target) ; image is (dimension x dimension x 3), target (dimension x dimension), both uint8.
+        With npy shards both are read only views of the memory map."""
+        return self.image(index), self.roi_in_percent(index), self.target(index)
+
+
+def open_dataset(path, dimension=2048, roi_percent_path="images_roi_percent_latest.json"):
+    """ShardDataset if path is a shard directory (has an index.json), RoiDataset of the resized images otherwise."""
+    if os.path.exists(os.path.join(path, 'index.json')):
+        return ShardDataset(path)
+    return RoiDataset(path, dimension, roi_percent_path)
+
+
+class BatchReader:
+    """Reads a RoiDataset or ShardDataset in batches, ahead of the consumer. Each batch is decoded by one thread of a pool
+    of workers; cv.imread, cv.imdecode and cv.resize release the GIL, so the threads decode in parallel. Up to
+    workers*prefetch batches are in work, the batches are yielded in order.
+
+    Example:
+        reader = BatchReader(open_dataset("/roi/latest_roi_repro_shards_2048"), batch_size=16, dimension=512, shuffle=True)
+        for images, rois_in_percent, targets in reader:
+            ...
+    """
+
+    def __init__(self, dataset, batch_size=16, workers=4, prefetch=2, dimension=None, reduced_decode=False, shuffle=False, seed=None, drop_last=False):
+        """
+        Args:
+            dataset        : RoiDataset or ShardDataset.
+            batch_size     : samples per batch.
+            workers        : decoding threads.
+            prefetch       : batches read ahead per worker.
+            dimension      : size of the images and targets of the batches, the images are downscaled on the fly;
+                             default: the dimension of the dataset.
+            reduced_decode : decode the jpegs at reduced size, if dimension is at most half of the stored size.
+            shuffle        : new random order of the samples on every iteration.
+            seed           : seed of the shuffling.
+            drop_last      : leave out the last batch, if it is smaller than batch_size.
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.workers = workers
+        self.prefetch = prefetch
+        self.dimension = dimension or dataset.dimension
+        self.reduced_decode = reduced_decode
+        self.shuffle = shuffle
+        self.random = np.random.default_rng(seed)
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset)//self.batch_size
+        return -(-len(self.dataset)//self.batch_size)
+
+    def read_batch(self, indices):
+        """Returns (images (n x dimension x dimension x 3) uint8, rois_in_percent (n x 4) float32, targets (n x dimension x dimension) uint8)."""
+        images = np.empty((len(indices), self.dimension, self.dimension, 3), dtype=np.uint8)
+        targets = np.empty((len(indices), self.dimension, self.dimension), dtype=np.uint8)
+        rois_in_percent = []
+        for i, index in enumerate(indices):
+            images[i] = self.dataset.image(index, self.dimension, self.reduced_decode)
+            targets[i] = self.dataset.target(index, self.dimension)
+            rois_in_percent.append(self.dataset.roi_in_percent(index))
+        return images, np.array(rois_in_percent, dtype=np.float32), targets
+
+    def __iter__(self):
+        order = self.random.permutation(len(self.dataset)) if self.shuffle else np.arange(len(self.dataset))
+        batches = [order[start:start+self.batch_size] for start in range(0, len(order), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1])<self.batch_size:
+            batches.pop()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            try:
+                for indices in batches:
+                    pending.append(executor.submit(self.read_batch, indices))
+                    if len(pending)>=self.workers*self.prefetch:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
@@ -1,11 +1,14 @@
-import cv2 as cv
+from annotation_store import AnnotationLog, ScanLedger, annotation_log, iter_annotations, iter_ledger, migrate_legacy_json, scan_ledger, truncate_after
+from concurrent.futures import ThreadPoolExecutor
+from create_gaussian_dataset import resized_and_gaussian_images, write_shards
+from fetch_images import fetch_images
 import json
+import metrics
+from mediagate_client import read_mediagate_info, read_mediagate_infos, read_fileinfo
 import numpy as np
 import os
-import requests
-import shutil
-from tqdm import tqdm
-import xml.etree.ElementTree as ET
+from pageboxes import read_pageboxes
+from path_resolver import exists, path_cache
 
 
 point_per_inch = 300
@@ -14,13 +17,6 @@ point_to_mm = inch_to_mm/point_per_inch
 mm_to_pixel = point_per_inch/ inch_to_mm
 
 
-def read_mediagate_info(mediagate_id):
-    request_url = 'https://api.saueressig.de/MediagateAPI/MediagateDetails'
-    information = {'ids' : [mediagate_id]}
-    search_response = requests.post(request_url, json = information, auth = ('web2gravure', '5#dlKjgjAwh!!'))
-    return search_response.json()['Result'][0]
-
-
 def get_xml_path(image_path):
     """Filenames under the json_file["IMAGE_PATH"] is not always correct.
     This method deals with this issue. The possible deviations are:
@@ -46,17 +42,18 @@ def get_xml_path(image_path):
         xml_path = image_path.replace('.jpg','.xml')
     if image_path.endswith('.jpeg'):
         xml_path = image_path.replace('.jpeg','.xml')
-    if not os.path.exists(xml_path):
+    if not exists(xml_path):
         xml_path = '_'.join(image_path.split('.')[:-1])+'.xml'
-    if not os.path.exists(xml_path):
+    if not exists(xml_path):
         print('--------------------------\n',xml_path, " doesn't exist \n")
         print("Life is boring, take some stress. \n\nBy the way, No xml file found\n")
         xml_path = None
     return xml_path
 
 
-def get_encoway_wh(mediagate_id):
-    mediagate_info = read_mediagate_info(str(mediagate_id))
+def get_encoway_wh(mediagate_id, mediagate_info=None):
+    if mediagate_info is None:
+        mediagate_info = read_mediagate_info(str(mediagate_id))
     if not mediagate_info['ENC_EBREITE'] or not mediagate_info['ENC_EHOEHE']:
         return 0,0
     enc_wh = np.array([float(mediagate_info['ENC_EBREITE']),float(mediagate_info['ENC_EHOEHE'])])
@@ -65,24 +62,26 @@ def get_encoway_wh(mediagate_id):
 def get_roi(xml_path): # in mm
     point_per_inch = 72
     point_to_mm = inch_to_mm/point_per_inch
-    if not os.path.exists(xml_path):
+    if not exists(xml_path):
         return 0,0,0,0
-    tree = ET.parse(xml_path)
-    root = tree.getroot() 
-    pageboxes_element = root.find("pageboxes")
-    media_element = pageboxes_element.find("media")
-    trim_element = pageboxes_element.find("trim")
+    with metrics.timed('xml_parse'):
+        pageboxes = read_pageboxes(xml_path)
+    if pageboxes is None:
+        raise ValueError(f"No pageboxes in {xml_path}")
 
     try:
-        media_offsetx = float(media_element.find("offsetx").text)
-        media_offsety = float(media_element.find("offsety").text)
-        media_height = float(media_element.find("height").text)
+        media_element = pageboxes["media"]
+        trim_element = pageboxes["trim"]
+
+        media_offsetx = float(media_element["offsetx"])
+        media_offsety = float(media_element["offsety"])
+        media_height = float(media_element["height"])
 
-        trim_offsetx = float(trim_element.find("offsetx").text)
-        trim_offsety = float(trim_element.find("offsety").text)
+        trim_offsetx = float(trim_element["offsetx"])
+        trim_offsety = float(trim_element["offsety"])
 
-        roi_height = float(trim_element.find("height").text) * point_to_mm
-        roi_width = float(trim_element.find("width").text) * point_to_mm
+        roi_height = float(trim_element["height"]) * point_to_mm
+        roi_width = float(trim_element["width"]) * point_to_mm
     except Exception as e:
         print("Error!", e.__class__, "occurred.")
         return 0,0,0,0
@@ -98,19 +97,32 @@ def get_roi(xml_path): # in mm
     
 
 def check_dimension(dimension_1, dimension_2, tolerance=0.02):
+    return bool(check_dimensions([dimension_1], [dimension_2], tolerance)[0])
 
-    d1_max = np.max(dimension_1)
-    d2_max = np.max(dimension_2)
-    diff_max = abs((d1_max-d2_max)/d2_max)
 
-    d1_min = np.min(dimension_1)
-    d2_min = np.min(dimension_2)
-    diff_min = abs((d1_min-d2_min)/d2_min)
+def check_dimensions(dimensions_1, dimensions_2, tolerance=0.02):
+    """check_dimension for many (w,h) pairs at once.
 
-    if ((diff_max<tolerance) and (diff_min<tolerance)):
-        return True
-    else:
-        return False
+    Args:
+        dimensions_1 : array (N,2) of width, height.
+        dimensions_2 : array (N,2) of width, height to compare with; rows with a 0 are never accepted.
+        tolerance    : tolerance.
+
+    Returns:
+        bool array (N,), True where max and min of the dimensions deviate less than tolerance
+    """
+    dimensions_1 = np.asarray(dimensions_1, dtype=np.float64).reshape(-1, 2)
+    dimensions_2 = np.asarray(dimensions_2, dtype=np.float64).reshape(-1, 2)
+
+    d1_max = np.max(dimensions_1, axis=1)
+    d2_max = np.max(dimensions_2, axis=1)
+    d1_min = np.min(dimensions_1, axis=1)
+    d2_min = np.min(dimensions_2, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        diff_max = np.abs((d1_max-d2_max)/d2_max)
+        diff_min = np.abs((d1_min-d2_min)/d2_min)
+
+    return (diff_max<tolerance) & (diff_min<tolerance)
 
 
 def mediagate_id_to_image_path(mediagate_id):
@@ -131,10 +143,7 @@ def mediagate_id_to_image_path(mediagate_id):
                 "STATUS":1,"MESSAGE":""    
             }
     """
-    url = 'http://devwebvm087.saueressig.de/mediagate/public/clynx/fileinfo?id=' + str(mediagate_id)
-
-    response = requests.get(url)
-    json_content = response.json()
+    json_content = read_fileinfo(mediagate_id)
     image_path = json_content['IMAGE_PATH']
     # lowres_url = json_content['IMAGE_URL']
 
@@ -152,205 +161,212 @@ def mediagate_id_to_image_path(mediagate_id):
     return image_path
 
 
-def roi_annotation(mediagate_id, tolerance = 0.02):
-    """For the given mediagate id compares the width height from the encoway with xml. Returns the x,y,w,h in mm if the deviation is within tolerance.
+def resolve_paths(mediagate_id):
+    """mediagate_id_to_image_path and get_xml_path, kept in the persistent path cache, so that a rerun
+    doesn't have to ask fileinfo or look on the share again. Paths that weren't found are not cached.
+
+    Returns:
+        (image_path, xml_path) ; image_path is None for dailies, xml_path is None if not found
+    """
+    key = f"{mediagate_id}@repro"
+    paths = path_cache.get(key)
+    if paths is not None:
+        return paths['image_path'], paths['xml_path']
+
+    image_path = mediagate_id_to_image_path(mediagate_id)
+    xml_path = None if image_path is None else get_xml_path(image_path)
+    if image_path is None or xml_path is not None:
+        path_cache.set(key, {'image_path': image_path, 'xml_path': xml_path})
+    return image_path, xml_path
+
+
+def raw_image_path(image_path):
+    splits = image_path.split('.')
+    return splits[0]+'_RAW.'+splits[1]
+
+
+def measure_roi(mediagate_id, mediagate_info = None):
+    """Collects everything roi_annotation decides on: the width height from the encoway and the roi from the xml.
 
     Args:
         mediagate_id : mediagate_id.
-        tolerance    : tolerance. 
+        mediagate_info : already fetched MediagateDetails of the id (see read_mediagate_infos). Fetched, if None.
 
     Returns:
-        dict(image_path : [x,y,w,h]) if the deviation is within tolerance; None otherwise
+        record of the scan ledger, see annotation_store.ScanLedger
     """
-    point_per_inch = 72
-    mm_to_inch = 1/25.4
-    mm_to_pixel = mm_to_inch * point_per_inch
-    enc_wh = get_encoway_wh(mediagate_id)
-    image_path = mediagate_id_to_image_path(mediagate_id)
+    enc_wh = get_encoway_wh(mediagate_id, mediagate_info)
+    image_path, xml_path = resolve_paths(mediagate_id)
     if image_path is None:
-        return None
-    xml_path = get_xml_path(image_path)
+        return {'mediagate_id': mediagate_id, 'outcome': 'daily'}
 
     if xml_path is None:
-        return None
+        return {'mediagate_id': mediagate_id, 'outcome': 'no_xml', 'image_path': image_path}
     x,y,w,h = get_roi(xml_path) # in mm
-    wh = np.array([w,h])
 
-    splits = image_path.split('.')
-    image_path_raw = splits[0]+'_RAW.'+splits[1]
-    if check_dimension(wh , enc_wh, tolerance=tolerance):
-        return {image_path_raw : [x,y,w,h]}
-    else:
+    return {'mediagate_id': mediagate_id, 'outcome': 'measured', 'image_path': image_path,
+            'enc_wh': [float(enc_wh[0]), float(enc_wh[1])], 'roi_mm': [x,y,w,h]}
+
+
+def accepted_annotation(record, tolerance = 0.02):
+    """Returns dict(image_path : [x,y,w,h]) of a measured record if the deviation is within tolerance; None otherwise"""
+    if record['outcome'] != 'measured':
         return None
+    x,y,w,h = record['roi_mm']
+    if check_dimension(np.array([w,h]), record['enc_wh'], tolerance=tolerance):
+        return {raw_image_path(record['image_path']) : [x,y,w,h]}
+    return None
 
 
-def fetch_images(roi_count, image_dir):
-    """Reads the paths from 'images_and_roi{roi_count}.json' and copies each image in image dir.
+def roi_annotation(mediagate_id, tolerance = 0.02, mediagate_info = None):
+    """For the given mediagate id compares the width height from the encoway with xml. Returns the x,y,w,h in mm if the deviation is within tolerance.
 
     Args:
-        roi_count : last roi count, floored to 100s. i.e. for 1870, it will be 1800.
-        image_dir : directory, where the images will be copied. 
+        mediagate_id : mediagate_id.
+        tolerance    : tolerance. 
+        mediagate_info : already fetched MediagateDetails of the id (see read_mediagate_infos). Fetched, if None.
 
     Returns:
-        None
+        dict(image_path : [x,y,w,h]) if the deviation is within tolerance; None otherwise
     """
-
-    if not os.path.exists(image_dir):
-        os.makedirs(image_dir)
-    
-    with open(f'images_and_roi{roi_count}.json') as f:
-        images_and_annotation = json.load(f)
-
-
-    for source_image_path in tqdm(images_and_annotation.keys()):
-        dest_image_path = os.path.join(image_dir,os.path.basename(source_image_path))
-        if not os.path.exists(dest_image_path):
-            if not os.path.exists(source_image_path):
-                if source_image_path.endswith('.jpg'):
-                    source_image_path = source_image_path.replace('.jpg','.jpeg')
-                elif source_image_path.endswith('.jpeg'):
-                    source_image_path = source_image_path.replace('.jpeg','.jpg')
-                if not os.path.exists(source_image_path):
-                    continue
-            
-            shutil.copy(source_image_path, dest_image_path)
+    return accepted_annotation(measure_roi(mediagate_id, mediagate_info), tolerance)
 
 
-def resize_and_write_image(image_path, output_dir, dimension=2048):
-    """Reads an image from path, resizes the image according to the given dimension and saves it to the output_dir.
-
-    Args:
-        image_path : path to the image.
-        output_dir : directory, where the images will be saved.
-        dimension  : dimension, to which image will be resized 
+def read_window_infos(window, executor):
+    """read_mediagate_infos for a window of ids. If the batch request fails (e.g. one bad id makes the endpoint answer 5xx),
+    the ids are looked up one by one with the threads of executor. Ids that fail again are left out, the scan records
+    them as errors and moves on.
 
     Returns:
-        Bool : True is successfull, False otherwise
+        dict(mediagate_id : mediagate_info)
     """
-    dest_path = os.path.join(output_dir, os.path.basename(image_path))
     try:
-        if os.path.exists(dest_path):
-            return True
-        image = cv.imread(image_path, cv.IMREAD_COLOR)
-        reduced_image = cv.resize(image, (dimension,dimension))
-        cv.imwrite(dest_path,reduced_image)
-        return True
+        return read_mediagate_infos(window)
     except Exception as e:
-        print(e.__class__)
-        return False
+        print("Error!", e.__class__, "occurred.")
+        metrics.count('scan_window_error')
 
+    def lookup(mediagate_id):
+        try:
+            return read_mediagate_info(mediagate_id)
+        except Exception:
+            return None
 
-def create_gaussian_image(image_path, xywh, output_dir, dimension=2048):
-    """Creates a numpy array in the shape of (dimension x dimension) with zeros.
-    The rectangle corresponding region of interest has 255. We apply gaussian blur, because the in the real image
-    the lines represent gaussian distribution. Normalize the blurred image so that maximum is 255.
+    mediagate_infos = {}
+    for mediagate_id, mediagate_info in zip(window, executor.map(lookup, window)):
+        if mediagate_info is not None:
+            mediagate_infos[str(mediagate_id)] = mediagate_info
+    return mediagate_infos
+
+
+def scan_mediagate_id(mediagate_id, mediagate_infos):
+    """measure_roi for one id of a scanned window. Raises KeyError, if the window has no MediagateDetails for the id."""
+    return measure_roi(mediagate_id, mediagate_info=mediagate_infos[str(mediagate_id)])
+
+
+def rebuild_annotations(tolerance=0.02, ledger_path=scan_ledger, log_path=annotation_log):
+    """Rebuilds the annotation log from the scan ledger for the given tolerance, without http calls or share access.
+    Entries of the log from before the ledger (legacy entries, ids below the first id of the ledger) are kept.
+
+    Returns:
+        number of annotations in the rebuilt log
+    """
+    ledger_records = list(iter_ledger(ledger_path))
+    first_id = min((record['mediagate_id'] for record in ledger_records), default=None)
+    records = [record for record in ledger_records if record['outcome'] == 'measured']
+    enc_wh = np.array([record['enc_wh'] for record in records], dtype=np.float64).reshape(-1, 2)
+    wh = np.array([record['roi_mm'][2:] for record in records], dtype=np.float64).reshape(-1, 2)
+    accepted = check_dimensions(wh, enc_wh, tolerance)
+
+    count = 0
+    with AnnotationLog(log_path + '.tmp') as rebuilt:
+        if os.path.exists(log_path):
+            for mediagate_id, image_path, roi_mm in iter_annotations(log_path):
+                if mediagate_id is None or first_id is None or mediagate_id < first_id:
+                    rebuilt.append(mediagate_id, {image_path: roi_mm})
+                    count += 1
+        for record, is_accepted in zip(records, accepted):
+            if is_accepted:
+                rebuilt.append(record['mediagate_id'], {raw_image_path(record['image_path']): record['roi_mm']})
+                count += 1
+        rebuilt.sync()
+    os.replace(log_path + '.tmp', log_path)
+    return count
+
+
+def update_roi_latest(start_mediagate_id, start_roi, batch_size=200, workers=1, tolerance=0.02):
+    """Scans the mediagate ids after start_mediagate_id and collects the roi annotations.
+    MediagateDetails are requested for a window of batch_size ids at once, the ids of the window
+    are then annotated by a pool of workers threads. The results are committed in mediagate id order,
+    so that last_scan.json is always a correct resume point. Every scanned id is also written to the
+    scan ledger with its measurements, see rebuild_annotations.
 
     Args:
-        image_path : uses this path just to save the image with this name, doesn't read the original image.
-        xywh : A list with [x,y,w,h]; the dimensions are in pixels.
-        output_dir : Directory to save the gaussian array/images.
-        dimension : The size of the array/image 
+        start_mediagate_id : last scanned mediagate id.
+        start_roi          : roi count of the last scan.
+        batch_size         : number of ids per MediagateDetails request.
+        workers            : number of ids annotated concurrently (http calls, share lookups, xml parsing).
+        tolerance          : tolerance of check_dimension.
 
     Returns:
-        None
+        (last mediagate id, roi count)
     """
-    x,y,w,h = [int(i*dimension) for i in xywh]
-    black = np.zeros((dimension, dimension), dtype= np.uint8)
-    if (x+w>=(dimension-1)):
-        w = dimension-x-2
-    if (y+h>=(dimension-1)):
-        h = dimension-y-2
-    black[y:y+h+1,x:x+w+1] = 255
-    black[y+1:y+h,x+1:x+w] = 0
-    black = cv.GaussianBlur(black, (5,5),1)
-    black = ((black.astype(np.float16)/black.max())*255).astype(np.uint8)
-
-    cv.imwrite(os.path.join(output_dir, os.path.basename(image_path)), black)
-
-def update_roi_latest(start_mediagate_id, start_roi):
-    
-    if os.path.exists(f'images_and_roi{start_roi}.json'):
-        with open(f'images_and_roi{start_roi}.json') as f:
-            images_and_annotation = json.load(f)
-    else:
-        images_and_annotation = {}
+
+    # hits after the last checkpoint are scanned (and appended) again
+    migrate_legacy_json()
+    truncate_after(start_mediagate_id)
+    truncate_after(start_mediagate_id, scan_ledger)
 
     error_count = 0
     roi_count_it = start_roi
     roi_count = start_roi
     mediagate_id = start_mediagate_id
 
-    while True:
-        mediagate_id += 1
-        # print(f"Start Mediagate_id : {mediagate_id} \n Roi Count : {roi_count_it}") # DEBUG
-        try:
-            annotation = roi_annotation(mediagate_id)
-            if annotation is None:
-                continue
-            roi_count_it+=1
-            print(annotation)
-            images_and_annotation.update(annotation)
-            
-            error_count = 0
-            if roi_count_it%100==0:
-                roi_count = roi_count_it
-                with open(f"images_and_roi{roi_count}.json",'w') as f:
-                    json.dump(images_and_annotation, f)
-                with open('last_scan.json','w') as f:
-                    json.dump({'last_mediagate_id':mediagate_id,'roi_count':roi_count}, f)
-        except Exception as e:
-            print("Error!", e.__class__, "occurred.")
-            error_count+=1
-        
-        if error_count>100:
-            break
-        
+    with ThreadPoolExecutor(max_workers=workers) as executor, AnnotationLog() as annotation_log_file, ScanLedger() as ledger:
+        while error_count<=100:
+            window = range(mediagate_id+1, mediagate_id+1+batch_size)
+            mediagate_infos = read_window_infos(window, executor)
+
+            futures = [executor.submit(scan_mediagate_id, window_id, mediagate_infos) for window_id in window]
+            for mediagate_id, future in zip(window, futures):
+                # print(f"Start Mediagate_id : {mediagate_id} \n Roi Count : {roi_count_it}") # DEBUG
+                try:
+                    try:
+                        record = future.result()
+                    except Exception as e:
+                        ledger.append({'mediagate_id': mediagate_id, 'outcome': 'error', 'error': e.__class__.__name__})
+                        metrics.count('scan_error')
+                        raise
+                    ledger.append(record)
+                    metrics.count('scan_' + record['outcome'])
+                    annotation = accepted_annotation(record, tolerance)
+                    if annotation is None:
+                        continue
+                    metrics.count('scan_accepted')
+                    roi_count_it+=1
+                    print(annotation)
+                    annotation_log_file.append(mediagate_id, annotation)
+
+                    error_count = 0
+                    if roi_count_it%100==0:
+                        roi_count = roi_count_it
+                        annotation_log_file.sync()
+                        ledger.sync()
+                        with open('last_scan.json','w') as f:
+                            json.dump({'last_mediagate_id':mediagate_id,'roi_count':roi_count}, f)
+                        metrics.write_textfile()
+                except Exception as e:
+                    print("Error!", e.__class__, "occurred.")
+                    error_count+=1
+
+                if error_count>100:
+                    for pending in futures:
+                        pending.cancel()
+                    break
+
+    metrics.write_textfile()
     return mediagate_id, roi_count
 
-def resized_and_gaussian_images(roi_count, image_dir, image_dir_dim, gaussian_dir):
-    with open(f'images_and_roi{roi_count}.json') as f:
-        images_and_roi_mm = json.load(f)
-
-    if os.path.exists("images_roi_percent_latest.json"):
-        with open("images_roi_percent_latest.json") as f:
-            local_images_roi_percentage_dict = json.load(f)
-    else:
-        local_images_roi_percentage_dict = {}
-
-    if not os.path.exists(gaussian_dir):
-        os.makedirs(gaussian_dir)
-
-    if not os.path.exists(image_dir_dim):
-        os.makedirs(image_dir_dim)
-    
-
-    for image_path, roi_mm in tqdm(images_and_roi_mm.items()):
-        local_image_path = os.path.join(image_dir, os.path.basename(image_path))
-        if not os.path.exists(local_image_path):
-            continue
-        if local_image_path in local_images_roi_percentage_dict:
-            if (os.path.exists(os.path.join(image_dir_dim, os.path.basename(local_image_path))) and os.path.exists(os.path.join(gaussian_dir, os.path.basename(local_image_path)))):
-                continue
-        try:
-            image = cv.imread(local_image_path,-1)
-            image_height, image_width, _ = image.shape
-            roi_pixel = [roi*mm_to_pixel for roi in roi_mm]
-            roi_in_percent = [roi_pixel[0]/image_width, roi_pixel[1]/image_height, roi_pixel[2]/image_width, roi_pixel[3]/image_height]
-            if not resize_and_write_image(local_image_path, image_dir_dim, dimension):
-                if local_image_path in local_images_roi_percentage_dict:
-                    local_images_roi_percentage_dict.pop(local_image_path, None)
-                continue
-            create_gaussian_image(local_image_path,roi_in_percent, gaussian_dir, dimension)
-
-            local_images_roi_percentage_dict.update({local_image_path:roi_in_percent})
-        except Exception as e:
-            print("Error : ",e.__class__)
-            if local_image_path in local_images_roi_percentage_dict:
-                local_images_roi_percentage_dict.pop(local_image_path, None)
-
-        with open("images_roi_percent_latest.json",'w') as f:
-            json.dump(local_images_roi_percentage_dict,f)
-
 if __name__ == "__main__":
 
     """
@@ -360,17 +376,19 @@ if __name__ == "__main__":
 
     Input : 
             1. last_scan.json
-            2. images_and_roi{roi_count}.json
+            2. images_and_roi.jsonl (created from images_and_roi{roi_count}.json on the first run)
             3. image directory
             4. image directory for reduced images
             5. image directory for gaussian images
 
     Output / Actions :
             1. last_scan.json -> updated after every 100 roi count
-            2. images_and_roi{roi_count}.json -> updated after every 100 roi count
+            2. images_and_roi.jsonl -> every roi is appended as soon as it is found
+               scan_ledger.jsonl -> every scanned id with its measurements (rebuild_annotations for another tolerance)
             3. images copied from the server to image directory
             4. resizes image and saves to the reduced image directory
             5. writes gaussian image in the given dimension
+            6. packs the resized and gaussian images into tar shards with an index (roi_dataset.ShardDataset)
             
 
     """
@@ -389,19 +407,42 @@ if __name__ == "__main__":
     dimension = 2048
     image_dir_dim = f"/roi/latest_roi_repro_{dimension}"
     gaussian_dir = f"/roi/latest_roi_repro_gaussian_{dimension}" #"C:\\Users\\rislam\\Documents\\Python Scripts\\ROI\\images\\gaussian_2048"
-
-    # xxxxx  --------- Update Json -------- xxxxx #
-
-    print("Function : update_roi_latest")
-    mediagate_id, roi_count = update_roi_latest(mediagate_id, roi_count)
-
-    # xxxxx  --------- FETCH IMAGES -------- xxxxx #
-    print("Function : fetch_images")
-    fetch_images(roi_count, "/roi/latest_roi_repro")
-
-    # xxxxx --------- Write images with reduced size and gaussian images -------- #
-    print("Function : resized_and_gaussian_images")
-    resized_and_gaussian_images(roi_count, image_dir, image_dir_dim, gaussian_dir)
+    scan_workers = 16 # ids annotated concurrently by update_roi_latest
+    copy_workers = 8 # concurrent copies from the share
+    render_workers = os.cpu_count() # processes for resizing and gaussian images
+    reduced_decode = True # decode the jpegs at reduced size (>= dimension) before resizing, see compare_reduced_decode
+    shard_dir = f"/roi/latest_roi_repro_shards_{dimension}" # packed training shards
+    pack_shards = False # pack the images into shard_dir after rendering (for training with roi_dataset.ShardDataset)
+
+    # stage latencies, counters and bytes are written to metrics.metrics_path (roi_metrics_update_dataset.prom) after every stage,
+    # a cProfile of the whole run to ROI_PROFILE if set
+    with metrics.profiled():
+
+        # xxxxx  --------- Update Json -------- xxxxx #
+
+        print("Function : update_roi_latest")
+        with metrics.timed('update_roi_latest'):
+            mediagate_id, roi_count = update_roi_latest(mediagate_id, roi_count, workers=scan_workers)
+        metrics.write_textfile()
+
+        # xxxxx  --------- FETCH IMAGES -------- xxxxx #
+        print("Function : fetch_images")
+        with metrics.timed('fetch_images'):
+            fetch_images(image_dir, workers=copy_workers)
+        metrics.write_textfile()
+
+        # xxxxx --------- Write images with reduced size and gaussian images -------- #
+        print("Function : resized_and_gaussian_images")
+        with metrics.timed('resized_and_gaussian_images'):
+            resized_and_gaussian_images(image_dir, image_dir_dim, gaussian_dir, dimension, workers=render_workers, reduced_decode=reduced_decode)
+        metrics.write_textfile()
+
+        # xxxxx --------- Pack resized and gaussian images into training shards -------- #
+        if pack_shards:
+            print("Function : write_shards")
+            with metrics.timed('write_shards'):
+                write_shards(image_dir_dim, shard_dir, dimension, gaussian_dir=gaussian_dir)
+            metrics.write_textfile()
 
     print("DONE!")
 